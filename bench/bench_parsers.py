@@ -0,0 +1,180 @@
+# Compare perf.py's streaming page parsers against the html.parser-based
+# ones it used to have, on the saved pages in bench/fixtures. Checks that
+# both find the same results, then reports pages and megabytes parsed per
+# second for each: the old parsers on the whole page at once, and the new
+# ones both on the whole page and on the page split into network-sized
+# chunks.
+
+import argparse
+import os
+import re
+import sys
+import time
+from html.parser import HTMLParser
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.realpath( __file__ ) ), ".." ) )
+import perf
+
+FIXTURES = os.path.join( os.path.dirname( os.path.realpath( __file__ ) ), "fixtures" )
+
+def alist_find( alist, key ):
+    for (k,v) in alist:
+        if k == key: return v
+    return None
+
+# The old perf.TableParser and its subclasses
+class LegacyTableParser( HTMLParser ):
+    def __init__( self ):
+        HTMLParser.__init__( self )
+        self.tag_stack = []
+        self.cur_col = 0
+        self.in_td = 0
+
+    def handle_starttag( self, tag, attrs ):
+        self.tag_stack.append( tag )
+        if tag == "tr":
+            self.cur_col = -1
+        if tag == "td":
+            self.cur_col += 1
+            self.in_td += 1
+
+    def handle_endtag( self, tag ):
+        self.tag_stack = self.tag_stack[:-1]
+        if tag == "td":
+            self.in_td -= 1
+
+    def cur_tag( self ):
+        if len( self.tag_stack ) == 0:
+            return None
+        else:
+            return self.tag_stack[-1]
+
+class LegacyTournamentResultsParser( LegacyTableParser ):
+    def __init__( self ):
+        LegacyTableParser.__init__( self )
+        self.xtbl = None
+        self.rating = 0
+        self.results = []
+        self.any_results = False
+
+    def handle_starttag( self, tag, attrs ):
+        LegacyTableParser.handle_starttag( self, tag, attrs )
+        if tag == "a":
+            if self.cur_col == 1:
+                xtbl_link = alist_find( attrs, "href" )
+                m = perf.xtbl_re.search( xtbl_link )
+                if m:
+                    self.xtbl = m.group( 1 )
+                    self.any_results = True
+
+    def handle_endtag( self, tag ):
+        LegacyTableParser.handle_endtag( self, tag )
+        if tag == "tr" and self.xtbl and self.rating != 0:
+            self.results.append( perf.TournamentResult( self.xtbl, self.rating ) )
+            self.xtbl = None
+            self.rating = 0
+
+    def handle_data( self, data ):
+        if self.in_td > 0:
+            if self.cur_col == 2 and self.cur_tag() == "b" and self.xtbl:
+                m = re.match( r"\d+", data )
+                self.rating = int( m.group( 0 ) )
+
+class LegacyYearResultsParser( LegacyTableParser ):
+    def __init__( self ):
+        LegacyTableParser.__init__( self )
+        self.rating = 0
+        self.results = []
+        self.reading_data = False
+        self.xtbl = None
+        self.rd = 0
+        self.result = None
+
+    def handle_starttag( self, tag, attrs ):
+        LegacyTableParser.handle_starttag( self, tag, attrs )
+        if tag == "a":
+            if self.cur_col == 0:
+                xtbl_link = alist_find( attrs, "href" )
+                m = perf.xtbl_re.search( xtbl_link )
+                if m:
+                    self.xtbl = m.group( 1 )
+
+    def handle_endtag( self, tag ):
+        LegacyTableParser.handle_endtag( self, tag )
+        if tag == "tr" and self.result:
+            self.results.append( perf.Result( self.rating, self.result, self.xtbl, self.rd ) )
+            self.xtbl = None
+            self.rd = 0
+            self.rating = 0
+            self.result = None
+
+    def handle_data( self, data ):
+        if not self.reading_data and self.cur_tag() == "th" and data == "Event Name":
+            self.reading_data = True
+
+        if self.reading_data:
+            if self.in_td > 0:
+                if self.cur_col == 2:
+                    self.rd = int( data )
+                elif self.cur_col == 6:
+                    m = perf.rating_re.search( data )
+                    if m:
+                        self.rating = int( m.group( 1 ) )
+                elif self.cur_col == 7:
+                    self.result = data[0]
+
+def legacy_parse( parser_class, text ):
+    parser = parser_class()
+    parser.feed( text )
+    parser.close()
+    return parser.results
+
+def streaming_parse( parser_class, chunks ):
+    return list( parser_class().parse( chunks ) )
+
+def split( text, size ):
+    return [ text[i:i+size] for i in range( 0, len( text ), size ) ]
+
+# Seconds per call of fn(), over at least `min_time` seconds
+def time_per_call( fn, min_time ):
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls
+
+def main():
+    parser = argparse.ArgumentParser( description="Benchmark USCF page parsers" )
+    parser.add_argument( "-t", "--time", type=float, default=1.0,
+                         help="Seconds to spend timing each parser on each page" )
+    parser.add_argument( "-c", "--chunk", type=int, default=1460,
+                         help="Size of the pieces a page is fed in, in characters" )
+    args = parser.parse_args()
+
+    pages = [ ("gamestats.html", LegacyYearResultsParser, perf.YearResultsParser),
+              ("tnmthst.html", LegacyTournamentResultsParser, perf.TournamentResultsParser) ]
+    print( "%-16s %-18s %8s %9s %8s" % ("Page", "Parser", "Results", "Pages/s", "MB/s") )
+    for (name, legacy_class, new_class) in pages:
+        with open( os.path.join( FIXTURES, name ), encoding="iso-8859-1" ) as f:
+            text = f.read()
+        chunks = split( text, args.chunk )
+        expected = legacy_parse( legacy_class, text )
+        for got in (streaming_parse( new_class, [ text ] ), streaming_parse( new_class, chunks )):
+            if [ repr( r ) for r in got ] != [ repr( r ) for r in expected ]:
+                sys.exit( "%s: streaming parser disagrees with html.parser" % name )
+
+        runs = [ ("html.parser", lambda: legacy_parse( legacy_class, text )),
+                 ("streaming, whole", lambda: streaming_parse( new_class, [ text ] )),
+                 ("streaming, chunks", lambda: streaming_parse( new_class, chunks )) ]
+        base = None
+        for (label, fn) in runs:
+            t = time_per_call( fn, args.time )
+            base = base or t
+            print( "%-16s %-18s %8d %9.0f %8.2f  x%.1f" % (name, label, len( expected ), 1 / t,
+                                                          len( text ) / t / 1e6, base / t) )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Measure how fast pgnbytime.py splits up a PGN file, against the
+# line-at-a-time splitter it used to be. The input is a made-up ICC-style
+# archive of the given size, with games in many time controls; both
+# splitters must write the same files, byte for byte.
+
+import argparse
+import filecmp
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.realpath( __file__ ) ), ".." ) )
+import pgnbytime
+
+# The old pgnbytime.py
+def legacy_split_pgn( in_filename ):
+    file_dict = {}
+    state = { "in_header": True, "game_lines": [], "time_control": "_" }
+    rootname = os.path.splitext( in_filename )[0]
+
+    def tc_to_file( tc ):
+        try:
+            return file_dict[tc]
+        except KeyError:
+            f = open( rootname + " " + tc + ".pgn", "w" )
+            file_dict[tc] = f
+            return f
+
+    def dump_game():
+        f = tc_to_file( pgnbytime.time_control_to_str( state["time_control"] ) )
+        f.writelines( state["game_lines"] )
+        state["time_control"] = "_"
+        state["game_lines"] = []
+
+    for l in open( in_filename ):
+        if l[0] == "[" and not state["in_header"]:
+            dump_game()
+            state["in_header"] = True
+        if state["in_header"]:
+            if l[0] == "[":
+                m = re.search( "TimeControl \"(.+)\"", l )
+                if m:
+                    state["time_control"] = m.group( 1 )
+            else:
+                state["in_header"] = False
+        state["game_lines"] += l
+    dump_game()
+    for f in file_dict.values():
+        f.close()
+
+MOVES = ("1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Ba4 Nf6 5. O-O Be7 6. Re1 b5 7. Bb3 d6\n"
+         "8. c3 O-O 9. h3 Nb8 10. d4 Nbd7 11. c4 c6 12. cxb5 axb5 13. Nc3 Bb7 1/2-1/2\n")
+
+def write_archive( path, megabytes, seed ):
+    rng = random.Random( seed )
+    controls = [ "%d+%d" % (60 * minutes, inc) for minutes in (1, 2, 3, 5, 15, 45)
+                 for inc in (0, 2, 5, 12) ]
+    with open( path, "w" ) as f:
+        i = 0
+        while f.tell() < megabytes << 20:
+            f.write( '[Event "ICC %s"]\n[Site "Internet Chess Club"]\n[Date "2010.01.01"]\n'
+                     '[White "Player%d"]\n[Black "Player%d"]\n[Result "1/2-1/2"]\n'
+                     '[TimeControl "%s"]\n\n%s\n'
+                     % (i, rng.randrange( 1000 ), rng.randrange( 1000 ), rng.choice( controls ), MOVES) )
+            i += 1
+
+def timed( fn, *args ):
+    start = time.perf_counter()
+    fn( *args )
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser( description="Benchmark splitting PGN by time control" )
+    parser.add_argument( "-m", "--megabytes", type=int, default=100,
+                         help="Size of the archive to split" )
+    parser.add_argument( "-j", "--processes", type=int,
+                         help="Processes for the new splitter (default: one per CPU)" )
+    parser.add_argument( "-s", "--seed", type=int, default=1 )
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp()
+    dirs = [ os.path.join( work, d ) for d in ("legacy", "new") ]
+    for d in dirs:
+        os.mkdir( d )
+    write_archive( os.path.join( dirs[0], "icc.pgn" ), args.megabytes, args.seed )
+    shutil.copy( os.path.join( dirs[0], "icc.pgn" ), dirs[1] )
+    size = os.path.getsize( os.path.join( dirs[0], "icc.pgn" ) )
+
+    for (label, d, fn, fn_args) in (("line at a time", dirs[0], legacy_split_pgn, ()),
+                                    ("mapped chunks", dirs[1], pgnbytime.split_pgn, (args.processes,))):
+        elapsed = timed( fn, os.path.join( d, "icc.pgn" ), *fn_args )
+        print( "%-16s %7.2f s %8.1f MB/s" % (label, elapsed, size / elapsed / 1e6) )
+    names = [ sorted( os.listdir( d ) ) for d in dirs ]
+    (match, mismatch, errors) = filecmp.cmpfiles( dirs[0], dirs[1], names[0], shallow=False )
+    shutil.rmtree( work )
+    if mismatch or errors or names[0] != names[1]:
+        sys.exit( "Splitters disagree on %s" % ", ".join( mismatch + errors or [ "which files to write" ] ) )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Measure how many diagrams per second chessdiag.fen_to_image() renders,
+# against the old way of cutting every square and margin out of the
+# reference diagrams as it's pasted. Boards are random positions, rendered
+# with every combination of margin, flip and side to move, best of three
+# runs; both renderers must produce the same pixels.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.realpath( __file__ ) ), ".." ) )
+import chessdiag
+
+# The old chessdiag.add_square() and add_margins()
+def legacy_add_square( img, col, row, piece, options ):
+    color = chessdiag.square_color( col, row )
+    sq_pic = chessdiag.reference_diagrams()[0].sq_to_pic( chessdiag.square_dict[piece][color] )
+    margin = chessdiag.REF_MARGIN if options.show_side else 0
+    display_col = 7 - col if options.flip else col
+    display_row = 7 - row if options.flip else row
+    img.paste( sq_pic, (chessdiag.REF_SQ_SIZE * display_col + 1 + margin,
+                        chessdiag.REF_SQ_SIZE * display_row + 1) )
+
+def legacy_add_margins( img, options ):
+    margin_img = chessdiag.reference_diagrams()[2 * options.flip + options.black_to_move].img
+    for box in (chessdiag.left_margin_box(), chessdiag.bottom_margin_box()):
+        img.paste( margin_img.crop( box ), box )
+    return img
+
+def legacy_fen_to_image( fen, options ):
+    saved = (chessdiag.add_square, chessdiag.add_margins)
+    (chessdiag.add_square, chessdiag.add_margins) = (legacy_add_square, legacy_add_margins)
+    try:
+        return chessdiag.fen_to_image( fen, options )
+    finally:
+        (chessdiag.add_square, chessdiag.add_margins) = saved
+
+def random_fen( rng, density ):
+    rows = []
+    for r in range( 8 ):
+        row = ""
+        empty = 0
+        for c in range( 8 ):
+            if rng.random() < density:
+                if empty:
+                    row += str( empty )
+                    empty = 0
+                row += rng.choice( "PRNBQKprnbqk" )
+            else:
+                empty += 1
+        if empty:
+            row += str( empty )
+        rows.append( row )
+    return "/".join( rows ) + " w - - 0 1"
+
+def options( side, flip, btm ):
+    return argparse.Namespace( show_side=side, flip=flip, black_to_move=btm )
+
+# Seconds taken to render every job
+def time_renders( render, jobs ):
+    start = time.perf_counter()
+    for (fen, side, flip, btm) in jobs:
+        render( fen, options( side, flip, btm ) )
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser( description="Benchmark chessdiag diagram rendering" )
+    parser.add_argument( "-n", "--boards", type=int, default=100,
+                         help="Number of random positions" )
+    parser.add_argument( "-s", "--seed", type=int, default=1 )
+    args = parser.parse_args()
+
+    rng = random.Random( args.seed )
+    jobs = [ (random_fen( rng, 0.3 ), side, flip, btm)
+             for i in range( args.boards )
+             for side in (False, True) for flip in (False, True) for btm in (False, True) ]
+
+    start = time.perf_counter()
+    chessdiag.sprites()
+    print( "Loading sprites: %.1f ms" % ((time.perf_counter() - start) * 1000) )
+    for (label, render) in (("reference crops", legacy_fen_to_image),
+                            ("sprite atlas", chessdiag.fen_to_image)):
+        elapsed = min( time_renders( render, jobs ) for i in range( 3 ) )
+        print( "%-16s %8.0f diagrams/s" % (label, len( jobs ) / elapsed) )
+    for (fen, side, flip, btm) in jobs:
+        if (legacy_fen_to_image( fen, options( side, flip, btm ) ).tobytes() !=
+            chessdiag.fen_to_image( fen, options( side, flip, btm ) ).tobytes()):
+            sys.exit( "Renderers disagree on %s" % fen )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# Compare elo.perf_rating() against the finite-difference Newton solver
+# that perf.py used to have, on random tournaments of various sizes.
+# Reports, for each, the average number of iterations, the average number
+# of passes over the games (the old solver makes two per iteration, to
+# estimate the slope), how many solves hit the iteration cap, and wall
+# time per solve. The analytic solver is timed both on the whole batch at
+# once and one elo.perf_rating() call at a time.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.realpath( __file__ ) ), ".." ) )
+import elo
+
+def rating_diff_to_expected_value( d ):
+    return 1.0 / (1.0 + pow( 10.0, -d / 400.0 ))
+
+def expected_value_total_weighted( rating, opp_ratings, weights ):
+    return sum( weights[i] * rating_diff_to_expected_value( rating - r )
+                for (i,r) in enumerate( opp_ratings ) )
+
+# The old perf.accurate_perf_rating_raw_weighted(), returning the
+# iteration count and number of passes over the games as well
+def legacy_perf_rating( opp_ratings, score, weights ):
+    if score == 0:
+        return (min( opp_ratings ) - 400, 0, 0)
+    elif score == len( opp_ratings ):
+        return (max( opp_ratings ) + 400, 0, 0)
+    test_rating = sum( opp_ratings ) / len( opp_ratings )
+    iterations = 0
+    passes = 0
+    while iterations < 50:
+        eps = 1
+        test_score = expected_value_total_weighted( test_rating, opp_ratings, weights )
+        passes += 1
+        if abs( test_score - score ) < 0.001:
+            break
+        test_score_2 = expected_value_total_weighted( test_rating+eps, opp_ratings, weights )
+        passes += 1
+        slope = float( test_score_2 - test_score ) / eps
+        test_rating -= (test_score - score) / slope
+        iterations += 1
+    return (test_rating, iterations, passes)
+
+# A random tournament of `num_games` games: (opp_ratings, score, weights)
+def random_problem( rng, num_games ):
+    own = rng.uniform( 1000, 2400 )
+    opp_ratings = [ int( own + rng.gauss( 0, 200 ) ) for i in range( num_games ) ]
+    weights = [ rng.uniform( 0.05, 1.0 ) for i in range( num_games ) ]
+    score = 0.0
+    for (w, r) in zip( weights, opp_ratings ):
+        score += w * rng.choice( [0.0, 0.5, 1.0] ) * (1.5 if own > r else 0.75)
+    score = min( score, 0.99 * sum( weights ) )
+    return (opp_ratings, score, weights)
+
+def run( game_counts, problems, seed ):
+    print( "%6s  %-30s %-30s %-9s %s" % ("games", "legacy iters passes capped ms",
+                                          "batched iters passes capped ms",
+                                          "single ms", "max |diff|") )
+    for num_games in game_counts:
+        rng = random.Random( seed )
+        cases = [ random_problem( rng, num_games ) for i in range( problems ) ]
+
+        start = time.perf_counter()
+        legacy = [ legacy_perf_rating( *case ) for case in cases ]
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        (ratings, iterations) = elo.solve_perf_ratings( [ c[0] for c in cases ],
+                                                        [ c[2] for c in cases ],
+                                                        [ c[1] for c in cases ] )
+        new_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for (opp_ratings, score, weights) in cases:
+            elo.perf_rating( opp_ratings, score, weights )
+        scalar_time = time.perf_counter() - start
+
+        legacy_iters = sum( l[1] for l in legacy ) / float( problems )
+        legacy_passes = sum( l[2] for l in legacy ) / float( problems )
+        legacy_capped = sum( 1 for l in legacy if l[1] == 50 )
+        # The analytic solver makes exactly one pass per iteration
+        capped = (iterations == 100).sum()
+        diff = max( abs( r - l[0] ) for (r, l) in zip( ratings, legacy ) )
+        print( "%6d  %5.1f %6.1f %6d %10.3f  %5.1f %6.1f %6d %10.3f  %9.3f %.3f" %
+               (num_games,
+                legacy_iters, legacy_passes, legacy_capped, 1000 * legacy_time / problems,
+                iterations.mean(), iterations.mean(), capped, 1000 * new_time / problems,
+                1000 * scalar_time / problems, diff) )
+
+parser = argparse.ArgumentParser( description="Benchmark the performance rating solver." )
+parser.add_argument( "-g", "--games", help="Game counts to try", type=int, nargs="*",
+                     default=[ 5, 9, 30, 120, 1000 ] )
+parser.add_argument( "-n", "--problems", help="Problems per game count", type=int, default=200 )
+parser.add_argument( "-s", "--seed", help="Random seed", type=int, default=1 )
+
+if __name__ == "__main__":
+    options = parser.parse_args()
+    run( options.games, options.problems, options.seed )
@@ -0,0 +1,86 @@
+# Measure how long the diagram tools take to get going: each case runs in
+# a fresh interpreter, as the command-line tools do, and reports the time
+# to import chessdiag and do the first piece of work, as well as the wall
+# time of the whole process. Cases that recognize a diagram, with and
+# without a margin, are run both with the reference cache in place and
+# without it.
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.join( os.path.dirname( os.path.realpath( __file__ ) ), ".." )
+sys.path.insert( 0, REPO )
+import chessdiag
+
+FEN = "r1bqkb1r/pppp1ppp/2n2n2/4p3/2B1P3/5N2/PPPP1PPP/RNBQK2R w KQkq - 4 4"
+
+# Python run in the child: prints seconds spent importing and working
+CHILD = """
+import time
+start = time.perf_counter()
+import argparse, sys
+sys.path.insert( 0, %r )
+import chessdiag
+imported = time.perf_counter()
+%s
+print( imported - start, time.perf_counter() - imported )
+"""
+
+RENDER = "chessdiag.fen_to_image( %r, argparse.Namespace( show_side=True, flip=False, black_to_move=False ) )" % FEN
+
+def recognize( diagram ):
+    return "from PIL import Image\nchessdiag.image_to_fen( Image.open( %r ) )" % diagram
+
+def run_case( code ):
+    start = time.perf_counter()
+    out = subprocess.check_output( [ sys.executable, "-c", CHILD % (REPO, code) ] )
+    wall = time.perf_counter() - start
+    (imported, worked) = [ float( x ) for x in out.split() ]
+    return (imported, worked, wall)
+
+def median( xs ):
+    xs = sorted( xs )
+    return xs[len( xs ) // 2]
+
+def remove_cache():
+    if os.path.exists( chessdiag.REF_CACHE_FILE ):
+        os.remove( chessdiag.REF_CACHE_FILE )
+
+def main():
+    parser = argparse.ArgumentParser( description="Benchmark diagram tool startup" )
+    parser.add_argument( "-n", "--runs", type=int, default=10,
+                         help="Runs of each case; the median is reported" )
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    diagram = os.path.join( directory, "diagram.png" )
+    chessdiag.fen_to_image( FEN, argparse.Namespace( show_side=False, flip=False,
+                                                     black_to_move=False ) ).save( diagram )
+    margin_diagram = os.path.join( directory, "margin.png" )
+    chessdiag.fen_to_image( FEN, argparse.Namespace( show_side=True, flip=True,
+                                                     black_to_move=False ) ).save( margin_diagram )
+    cases = [ ("import only", "", None),
+              ("import numpy", "import numpy", None),
+              ("render a FEN", RENDER, None),
+              ("recognize, cached", recognize( diagram ), None),
+              ("recognize, no cache", recognize( diagram ), remove_cache),
+              ("margin, cached", recognize( margin_diagram ), None),
+              ("margin, no cache", recognize( margin_diagram ), remove_cache) ]
+    print( "%-20s %9s %9s %9s" % ("Case", "Import", "Work", "Process") )
+    for (label, code, before) in cases:
+        times = []
+        for i in range( args.runs ):
+            if before:
+                before()
+            times.append( run_case( code ) )
+        print( "%-20s %7.1fms %7.1fms %7.1fms" % ((label,) + tuple( median( t ) * 1000 for t in zip( *times ) )) )
+    os.remove( diagram )
+    os.remove( margin_diagram )
+    os.rmdir( directory )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Check which pages perf.py asks for, against the stand-in for the USCF
+# site in stub_uscf.py: a first fetch, an incremental refresh after some
+# new tournaments, a --full reread and an --offline run, each counting
+# the requests of each kind the stub got and the rows in the result store
+# afterwards. Exits with status 1 if any of them isn't as expected.
+#
+#   python bench/check_fetching.py
+
+import datetime
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname( os.path.realpath( __file__ ) )
+sys.path.insert( 0, os.path.join( BENCH_DIR, ".." ) )
+import perf
+import uscfhttp
+
+from stub_uscf import HISTORY_PAGE_SIZE, MEMBER_ID, StubUSCF
+
+# Tournaments rated between the first fetch and the refresh: more than fit
+# on the summary page, so the refresh has to read on into the history
+NEW_TOURNAMENTS = HISTORY_PAGE_SIZE + 3
+
+# -> (games, tournaments) in the player's result store
+def stored_rows():
+    db = sqlite3.connect( perf.store_file( MEMBER_ID ) )
+    counts = tuple( db.execute( "SELECT COUNT(*) FROM %s" % table ).fetchone()[0]
+                    for table in ("results", "tournaments") )
+    db.close()
+    return counts
+
+# { kind of page: requests } -> "n kind, ..."
+def describe( requests ):
+    return ", ".join( "%d %s" % (n, kind) for (kind, n) in sorted( requests.items() ) ) or "none"
+
+# Load the player the way perf.py -i does, with the page cache in
+# `cache_dir` -> { kind of page: requests }
+def load( stub, cache_dir, incremental=True, offline=False ):
+    perf.fetcher = uscfhttp.Fetcher( rate=0, cache=uscfhttp.ResponseCache( cache_dir, 100 << 20 ),
+                                     offline=offline )
+    perf.load_player( MEMBER_ID, incremental )
+    return stub.take_requests()
+
+def main():
+    stub = StubUSCF()
+    stub.start()
+    perf.USCF_BASE = stub.url
+    work = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir( work )
+    this_year = datetime.date.today().year
+    history_pages = stub.num_history_pages()
+    failures = 0
+    try:
+        checks = []
+        # Every year since 1994, then every page of the tournament history
+        # (the summary page is the first page of it, so <id>.1 isn't needed)
+        requests = load( stub, "cache1" )
+        checks.append( ("first fetch", requests, stored_rows(),
+                        { "year": this_year + 1 - 1994, "summary": 1, "history": history_pages - 1,
+                          "member": 1 },
+                        (stub.num_games(), len( stub.tournaments ))) )
+
+        # With a cold cache: only this year's games, and the history up to
+        # the first page with tournaments already known: the summary page,
+        # which is all new ones, and page 2
+        stub.add_tournaments( NEW_TOURNAMENTS )
+        requests = load( stub, "cache2" )
+        checks.append( ("incremental refresh", requests, stored_rows(),
+                        { "year": 1, "summary": 1, "history": 1, "member": 1 },
+                        (stub.num_games(), len( stub.tournaments ))) )
+
+        # --full rereads the whole tournament history
+        requests = load( stub, "cache3", incremental=False )
+        checks.append( ("--full", requests, stored_rows(),
+                        { "year": 1, "summary": 1, "history": stub.num_history_pages() - 1, "member": 1 },
+                        (stub.num_games(), len( stub.tournaments ))) )
+
+        # --offline gets everything from what --full cached
+        requests = load( stub, "cache3", offline=True )
+        checks.append( ("--offline", requests, stored_rows(), {},
+                        (stub.num_games(), len( stub.tournaments ))) )
+
+        print( "%-20s %-50s %s" % ("Run", "Requests", "Games, tournaments stored") )
+        for (label, requests, rows, expected_requests, expected_rows) in checks:
+            ok = requests == expected_requests and rows == expected_rows
+            failures += not ok
+            print( "%-20s %-50s %-12s %s" % (label, describe( requests ), "%d, %d" % rows,
+                                             "ok" if ok else "FAILED") )
+            if not ok:
+                print( "%-20s %-50s %d, %d" % ("  expected", describe( expected_requests ),
+                                              *expected_rows) )
+    finally:
+        os.chdir( cwd )
+        shutil.rmtree( work )
+        stub.stop()
+    if failures:
+        sys.exit( 1 )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+# Run benchmarks of the hot paths of chesstools on synthetic data (and the
+# saved pages in bench/fixtures), print how long each took, and write the
+# results as JSON. Results can be saved as a baseline and later runs
+# compared against it, flagging anything that got slower by more than
+# --threshold; the exit status is 1 if anything did.
+#
+#   python bench/run.py                       # run everything
+#   python bench/run.py -g solver curve       # just these groups of benchmarks
+#   python bench/run.py --save_baseline       # save results as bench/baseline.json
+#   python bench/run.py --compare             # compare with bench/baseline.json
+#
+# Every result is a time per operation, in seconds, so lower is better.
+# Baselines only mean anything on the machine they were made on. The
+# exit status is also 1 if perf.py --tnmt misses TNMT_STARTUP_TARGET.
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname( os.path.realpath( __file__ ) )
+sys.path.insert( 0, os.path.join( BENCH_DIR, ".." ) )
+import chessdiag
+import numpy as np
+import perf
+import pgnbytime
+import resultstore
+
+from bench_pgnbytime import write_archive
+from bench_render import random_fen
+
+DEFAULT_BASELINE = os.path.join( BENCH_DIR, "baseline.json" )
+FIXTURES = os.path.join( BENCH_DIR, "fixtures" )
+PERF = os.path.join( BENCH_DIR, "..", "perf.py" )
+
+# perf.py --tnmt gets called from scripts, once per tournament, so it
+# should take no more than this many seconds longer to run than a Python
+# that just imports NumPy (which it can't do without). Importing
+# matplotlib or requests would blow it several times over.
+TNMT_STARTUP_TARGET = 0.1
+
+# Seconds per call of fn(): the best of `repeat` runs, each calling it
+# until at least `min_time` seconds have passed
+def time_per_call( fn, min_time, repeat=3 ):
+    best = float( "inf" )
+    for i in range( repeat ):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min( best, elapsed / calls )
+    return best
+
+# A made-up history of `num_games` games by a player whose rating drifts,
+# a tournament of about five games every couple of weeks
+def synthetic_history( num_games, seed=1 ):
+    rng = np.random.default_rng( seed )
+    own = 1500 + np.cumsum( rng.normal( 0, 5, num_games ) )
+    opp_ratings = np.round( own + rng.normal( 0, 200, num_games ) ).astype( int )
+    expected = 1 / (1 + 10 ** (-(own - opp_ratings) / 400))
+    u = rng.random( num_games )
+    scores = np.where( u < 0.85 * expected, 1.0, np.where( u < 0.85 * expected + 0.15, 0.5, 0.0 ) )
+    tournaments = np.arange( num_games ) // 5
+    days = np.datetime64( "1995-01-01" ) + 14 * tournaments
+    ymd = np.array( [ int( str( d ).replace( "-", "" ) ) for d in days ] )
+    xtbls = ymd * 10000 + tournaments % 10000
+    rds = np.arange( num_games ) % 5 + 1
+    return resultstore.history_from_columns( opp_ratings, scores, xtbls, rds, ymd )
+
+# Each benchmark group: options -> iterator of (name, seconds per operation)
+
+def bench_solver( options ):
+    rng = random.Random( 1 )
+    for num_games in (5, 30, 120, 1000):
+        problems = []
+        for i in range( 50 ):
+            opp_ratings = [ rng.randint( 1000, 2400 ) for j in range( num_games ) ]
+            weights = [ rng.uniform( 0.05, 1.0 ) for j in range( num_games ) ]
+            problems.append( (opp_ratings, 0.4 * sum( weights ), weights) )
+        def solve_all():
+            for problem in problems:
+                perf.accurate_perf_rating_raw_weighted( *problem )
+        yield ("solver/%d games" % num_games,
+               time_per_call( solve_all, options.min_time ) / len( problems ))
+    # A club event's worth of --tnmt_file tournaments, solved as one batch
+    tournaments = []
+    for i in range( 500 ):
+        num_games = rng.randint( 3, 9 )
+        tournaments.append( ([ rng.randint( 1000, 2400 ) for j in range( num_games ) ],
+                             rng.randint( 0, 2 * num_games ) / 2.0) )
+    yield ("solver/bulk, per tournament",
+           time_per_call( lambda: perf.accurate_perf_ratings_raw( tournaments ), options.min_time )
+           / len( tournaments ))
+
+def bench_curve( options ):
+    for num_games in (500, 2000, 10000):
+        history = synthetic_history( num_games )
+        yield ("curve/%d games" % num_games,
+               time_per_call( lambda: perf.rating_curve( history ), options.min_time ))
+    history = synthetic_history( 10000 )
+    yield ("curve/10000 games, 365-day windows",
+           time_per_call( lambda: perf.rating_curve( history, window_days=365 ), options.min_time ))
+
+def bench_graph( options ):
+    history = synthetic_history( 2000 )
+    ratings = perf.rating_curve( history )
+    tnmt_results = [ perf.TournamentResult( str( x ), 1500 ) for x in np.unique( history["xtbl"] ) ]
+    work = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir( work )
+    os.mkdir( "out" )
+    try:
+        yield ("graph/render 2000 games",
+               time_per_call( lambda: perf.render_graph( "1", "Synthetic", history, tnmt_results,
+                                                         ratings, 0 ),
+                              options.min_time, 1 ))
+    finally:
+        os.chdir( cwd )
+        shutil.rmtree( work )
+
+def bench_parsers( options ):
+    for (page, parser_class) in (("gamestats.html", perf.YearResultsParser),
+                                 ("tnmthst.html", perf.TournamentResultsParser)):
+        with open( os.path.join( FIXTURES, page ), encoding="iso-8859-1" ) as f:
+            text = f.read()
+        yield ("parse/%s" % page,
+               time_per_call( lambda: list( parser_class().parse( [ text ] ) ), options.min_time ))
+
+def bench_diagrams( options ):
+    rng = random.Random( 1 )
+    fens = [ random_fen( rng, 0.3 ) for i in range( 50 ) ]
+    for show_side in (False, True):
+        label = "margin" if show_side else "no margin"
+        def render_all():
+            return [ chessdiag.fen_to_image( fen, argparse.Namespace( show_side=show_side, flip=False,
+                                                                      black_to_move=False ) )
+                     for fen in fens ]
+        yield ("diagram/fen_to_image, %s" % label,
+               time_per_call( render_all, options.min_time ) / len( fens ))
+        images = render_all()
+        yield ("diagram/image_to_fen, %s" % label,
+               time_per_call( lambda: [ chessdiag.image_to_fen( img ) for img in images ],
+                              options.min_time ) / len( fens ))
+
+def bench_pgn( options ):
+    work = tempfile.mkdtemp()
+    try:
+        pgn = os.path.join( work, "icc.pgn" )
+        write_archive( pgn, options.pgn_megabytes, 1 )
+        megabytes = os.path.getsize( pgn ) / 2.0**20
+        start = time.perf_counter()
+        pgnbytime.split_pgn( pgn, options.processes )
+        yield ("pgn/split, per MB", (time.perf_counter() - start) / megabytes)
+        start = time.perf_counter()
+        pgnbytime.GameIndex( pgn, options.processes ).close()
+        yield ("pgn/index, per MB", (time.perf_counter() - start) / megabytes)
+    finally:
+        shutil.rmtree( work )
+
+# Whole runs of a command, as scripts would run it
+def bench_startup( options ):
+    for (name, args) in (("startup/python -c 'import numpy'", [ "-c", "import numpy" ]),
+                         ("startup/perf.py --tnmt", [ PERF, "--tnmt", "1500", "1600", "1700", "2" ])):
+        command = [ sys.executable ] + args
+        yield (name, time_per_call( lambda: subprocess.run( command, stdout=subprocess.DEVNULL, check=True ),
+                                    options.min_time, 5 ))
+
+# Results -> whether perf.py --tnmt made TNMT_STARTUP_TARGET, if it was run
+def startup_target_met( results ):
+    if "startup/perf.py --tnmt" not in results:
+        return True
+    overhead = results["startup/perf.py --tnmt"] - results["startup/python -c 'import numpy'"]
+    met = overhead <= TNMT_STARTUP_TARGET
+    print( "\nperf.py --tnmt takes %s longer than importing NumPy (target: %s)%s"
+           % (format_time( overhead ).strip(), format_time( TNMT_STARTUP_TARGET ).strip(),
+              "" if met else "  MISSED") )
+    return met
+
+BENCHMARKS = [ ("solver", bench_solver),
+               ("curve", bench_curve),
+               ("graph", bench_graph),
+               ("parse", bench_parsers),
+               ("diagram", bench_diagrams),
+               ("pgn", bench_pgn),
+               ("startup", bench_startup) ]
+
+def machine():
+    return { "python": platform.python_version(),
+             "numpy": np.__version__,
+             "platform": platform.platform(),
+             "cpus": os.cpu_count() }
+
+def format_time( seconds ):
+    for (unit, scale) in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds * scale >= 1:
+            return "%8.2f %-2s" % (seconds * scale, unit)
+    return "%8.2f %-2s" % (seconds * 1e9, "ns")
+
+# Print how `results` compare with `baseline` (both { name: seconds });
+# returns the names of those more than `threshold` (a fraction) slower
+def compare( results, baseline, threshold ):
+    slower = []
+    print( "\n%-40s %11s %11s %7s" % ("Benchmark", "Baseline", "Now", "Ratio") )
+    for (name, seconds) in results.items():
+        if name not in baseline:
+            print( "%-40s %11s %s %7s" % (name, "-", format_time( seconds ), "new") )
+            continue
+        ratio = seconds / baseline[name]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  SLOWER"
+            slower.append( name )
+        elif ratio < 1 / (1 + threshold):
+            flag = "  faster"
+        print( "%-40s %s %s %6.2fx%s" % (name, format_time( baseline[name] ), format_time( seconds ),
+                                         ratio, flag) )
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser( description="Benchmark chesstools' hot paths" )
+    parser.add_argument( "-g", "--groups", nargs="+", choices=[ group for (group, fn) in BENCHMARKS ],
+                         help="Only run these groups of benchmarks" )
+    parser.add_argument( "-t", "--min_time", type=float, default=0.5,
+                         help="Seconds to spend on each timing run" )
+    parser.add_argument( "--pgn_megabytes", type=int, default=200,
+                         help="Size of the PGN archive to split" )
+    parser.add_argument( "-j", "--processes", type=int,
+                         help="Processes for splitting and indexing PGN (default: one per CPU)" )
+    parser.add_argument( "-o", "--output", help="Write the results as JSON to this file" )
+    parser.add_argument( "--save_baseline", nargs="?", const=DEFAULT_BASELINE, metavar="FILE",
+                         help="Save the results as the baseline (default: %s)" % DEFAULT_BASELINE )
+    parser.add_argument( "--compare", nargs="?", const=DEFAULT_BASELINE, metavar="FILE",
+                         help="Compare the results with a saved baseline (default: %s)" % DEFAULT_BASELINE )
+    parser.add_argument( "--threshold", type=float, default=0.1,
+                         help="How much slower than the baseline counts as slower (default: 0.1, i.e. 10%%)" )
+    args = parser.parse_args()
+
+    results = {}
+    for (group, fn) in BENCHMARKS:
+        if args.groups and group not in args.groups:
+            continue
+        for (name, seconds) in fn( args ):
+            results[name] = seconds
+            print( "%-40s %s" % (name, format_time( seconds )) )
+            sys.stdout.flush()
+
+    target_met = startup_target_met( results )
+
+    report = { "machine": machine(), "time": time.strftime( "%Y-%m-%d %H:%M:%S" ),
+               "results": results }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open( path, "w" ) as f:
+                json.dump( report, f, indent=2 )
+                f.write( "\n" )
+    if args.compare:
+        with open( args.compare ) as f:
+            baseline = json.load( f )
+        if baseline["machine"] != report["machine"]:
+            print( "\nNote: the baseline was made on a different machine or setup" )
+        if compare( results, baseline["results"], args.threshold ):
+            sys.exit( 1 )
+    if not target_met:
+        sys.exit( 1 )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# A stand-in for the USCF web site, serving made-up pages for one player in
+# the form perf.py parses, so that fetching can be tried out without
+# touching the real site:
+#
+#   python bench/stub_uscf.py 8765 &
+#   python perf.py -i 12345678 --base_url http://127.0.0.1:8765 --rate 0
+#
+# Each request is logged, so a check (see check_fetching.py) can count
+# what was asked for. The player plays TOURNAMENTS_PER_YEAR five-round
+# tournaments every year from FIRST_YEAR to this one; more can be added
+# with add_tournaments(), as if they'd just been rated.
+
+import datetime
+import random
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MEMBER_ID = "12345678"
+MEMBER_NAME = "JOHN Q DOE"
+FIRST_YEAR = 2015
+TOURNAMENTS_PER_YEAR = 8
+ROUNDS = 5
+HISTORY_PAGE_SIZE = 50          # Tournaments per page of the tournament history
+
+year_re = re.compile( r"dkey=(\d+)" )
+history_page_re = re.compile( r"MbrDtlTnmtHst\.php\?\d+\.(\d+)" )
+
+def year_page( games ):
+    rows = [ '<tr><td><a href="XtblMain.php?%s.1-%s">EVENT</a></td><td>1</td><td>%d</td><td>B</td>'
+             '<td>10000000</td><td>OPP NAME</td><td>%d =>&nbsp;%d</td><td>%s</td></tr>'
+             % (xtbl, MEMBER_ID, rd, opp_rating - 5, opp_rating, result)
+             for (xtbl, rd, opp_rating, result) in games ]
+    return ('<html><body><table><tr><td><table border=1><tr><th>Event Name</th><th>Sec</th>'
+            '<th>Rd</th><th>Color</th><th>Opp ID</th><th>Name</th><th>Rating</th><th>Res</th></tr>'
+            + "".join( rows ) + '</table></td></tr></table></body></html>')
+
+def history_page( tournaments, pages ):
+    links = "".join( '<a href="MbrDtlTnmtHst.php?%s.%d">%d</a>\n' % (MEMBER_ID, p, p) for p in pages )
+    rows = [ '<tr><td>%s-%s-%s<br>%s</td><td><a href="XtblMain.php?%s-%s">EVENT</a></td>'
+             '<td>R: 1500 =&gt; <b>%d</b></td></tr>'
+             % (xtbl[0:4], xtbl[4:6], xtbl[6:8], xtbl, xtbl, MEMBER_ID, rating)
+             for (xtbl, rating) in tournaments ]
+    return ('<html><body>\n%s<table>\n<tr><td>Date</td><td>Event</td><td>Reg</td></tr>\n%s\n'
+            '</table></body></html>' % (links, "\n".join( rows )))
+
+def member_page():
+    return ('<html><body><table><tr><td><b>%s: %s</b></td></tr></table></body></html>'
+            % (MEMBER_ID, MEMBER_NAME.replace( " ", "&nbsp;" )))
+
+class StubUSCF():
+    def __init__( self, port=0, seed=1 ):
+        self.rng = random.Random( seed )
+        self.lock = threading.Lock()
+        self.requests = []      # Paths asked for, in order
+        self.games = {}         # year -> [(xtbl, round, opponent rating, result)]
+        self.tournaments = []   # [(xtbl, rating)], newest first
+        self.serial = 0
+        for year in range( FIRST_YEAR, datetime.date.today().year + 1 ):
+            for month in range( 1, TOURNAMENTS_PER_YEAR + 1 ):
+                self.add_tournament( datetime.date( year, month, 1 ) )
+        stub = self
+
+        class Handler( BaseHTTPRequestHandler ):
+            def log_message( self, *args ):
+                pass
+
+            def do_GET( self ):
+                body = stub.page( self.path )
+                if body is None:
+                    self.send_response( 404 )
+                    self.end_headers()
+                    return
+                data = body.encode( "iso-8859-1" )
+                self.send_response( 200 )
+                self.send_header( "Content-Type", "text/html; charset=iso-8859-1" )
+                self.send_header( "Content-Length", str( len( data ) ) )
+                self.end_headers()
+                self.wfile.write( data )
+
+        self.server = ThreadingHTTPServer( ("127.0.0.1", port), Handler )
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    # A tournament played on `date`, newest so far
+    def add_tournament( self, date ):
+        with self.lock:
+            self.serial += 1
+            xtbl = "%s%04d" % (date.strftime( "%Y%m%d" ), self.serial)
+            self.games.setdefault( date.year, [] ).extend(
+                (xtbl, rd, self.rng.randint( 1200, 2200 ), self.rng.choice( "WLD" ))
+                for rd in range( 1, ROUNDS + 1 ) )
+            self.tournaments.insert( 0, (xtbl, self.rng.randint( 1400, 1800 )) )
+
+    # `count` tournaments played today
+    def add_tournaments( self, count ):
+        for i in range( count ):
+            self.add_tournament( datetime.date.today() )
+
+    def num_games( self ):
+        with self.lock:
+            return sum( len( games ) for games in self.games.values() )
+
+    def num_history_pages( self ):
+        with self.lock:
+            return max( 1, -(-len( self.tournaments ) // HISTORY_PAGE_SIZE) )
+
+    # Request path -> page text, or None if there's no such page
+    def page( self, path ):
+        with self.lock:
+            self.requests.append( path )
+            if "gamestats.php" in path:
+                return year_page( self.games.get( int( year_re.search( path ).group( 1 ) ), [] ) )
+            if "MbrDtlTnmtHst.php" in path:
+                m = history_page_re.search( path )
+                page = int( m.group( 1 ) ) if m else 1
+                start = (page - 1) * HISTORY_PAGE_SIZE
+                tournaments = self.tournaments[start:start + HISTORY_PAGE_SIZE]
+                # Only the summary page links to the numbered pages
+                num_pages = -(-len( self.tournaments ) // HISTORY_PAGE_SIZE)
+                pages = range( 1, num_pages + 1 ) if not m and num_pages > 1 else []
+                return history_page( tournaments, pages )
+            if "MbrDtlMain.php" in path:
+                return member_page()
+            return None
+
+    # -> { kind of page: number of requests for it } since the last call
+    def take_requests( self ):
+        with self.lock:
+            (requests, self.requests) = (self.requests, [])
+        counts = {}
+        for path in requests:
+            if "gamestats.php" in path:
+                kind = "year"
+            elif history_page_re.search( path ):
+                kind = "history"
+            elif "MbrDtlTnmtHst.php" in path:
+                kind = "summary"
+            else:
+                kind = "member"
+            counts[kind] = counts.get( kind, 0 ) + 1
+        return counts
+
+    def start( self ):
+        threading.Thread( target=self.server.serve_forever, daemon=True ).start()
+
+    def stop( self ):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    stub = StubUSCF( int( sys.argv[1] ) if len( sys.argv ) > 1 else 8765 )
+    print( "Serving made-up pages for USCF ID %s at %s" % (MEMBER_ID, stub.url) )
+    stub.server.serve_forever()
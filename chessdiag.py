@@ -1,12 +1,15 @@
-from PIL import Image, ImageChops
+from PIL import Image
 import os
-
-def img_equal( im1, im2 ):
-    return ImageChops.difference( im1, im2 ).getbbox() is None
+import pickle
+import sys
 
 REF_SQ_SIZE = 30                # size of squares in reference art
 REF_MARGIN = 15                 # width of margin in reference art
 
+# Squares recognized with less confidence than this (see classify_tiles)
+# are worth a second look
+LOW_CONFIDENCE = 0.5
+
 script_dir = os.path.dirname( os.path.realpath( __file__ ) )
 
 # Does this image have a margin?
@@ -19,7 +22,7 @@ def image_has_margin( img ):
             return True
     raise Exception( "Bad image dimensions %dx%d" % (width, height) )
 
-# Mapping of FEN character to dark/light squares in ref_diagrams[0]
+# Mapping of FEN character to dark/light squares in reference_diagrams()[0]
 square_dict = {
     'P': ('a1', 'a2'),
     'R': ('b2', 'b1'),
@@ -36,32 +39,38 @@ square_dict = {
     ' ': ('g1', 'g2')
 }
 
-# Declare this now so the Diagram constructor can refer to it
-ref_diagrams = []
-
 class Diagram:
 
     def __init__( self, img, flipped=None, black_to_move=None ):
         self.img = img
+        self.classified = None  # See classify_squares()
+        self.facing_guessed = False # See deduce_state()
         self.has_margin = image_has_margin( img )
         self.margin = REF_MARGIN * self.has_margin
-        if self.has_margin:
-            if flipped is None:
-                bottom_margin = self.bottom_margin_pic()
-                for ref in ref_diagrams:
-                    if img_equal( bottom_margin, ref.bottom_margin_pic() ):
-                        self.flipped = ref.flipped
-                        self.black_to_move = ref.black_to_move
-            else:
-                self.flipped = flipped
-                self.black_to_move = black_to_move
+        if flipped is not None:
+            self.flipped = flipped
+            self.black_to_move = black_to_move
+        elif self.has_margin:
+            (self.flipped, self.black_to_move) = margin_state( self.bottom_margin_pic() )
         else:
             self.deduce_state()
 
-    # Figure out whether the board is flipped.
+    # Figure out whether the board is flipped, from where the pawns are
+    # (see facing_score()); there's no telling whose move it is. Without
+    # clear evidence White is taken to be at the bottom, as it always used
+    # to be, and facing_guessed is set. That takes classifying the
+    # squares, so keep the result for classify_squares().
     def deduce_state( self ):
         self.flipped = False
         self.black_to_move = False
+        (chars, confidence) = classify_tiles( self.tiles() )
+        score = facing_score( chars )
+        pawns = sum( (chars == c).sum() for c in "Pp" )
+        self.facing_guessed = bool( pawns < MIN_FACING_PAWNS or abs( score ) <= FACING_THRESHOLD )
+        if score < 0 and not self.facing_guessed:
+            self.flipped = True
+            (chars, confidence) = (chars[::-1, ::-1], confidence[::-1, ::-1])
+        self.classified = (chars, confidence)
 
     def left_margin_pic( self ):
         MARGIN_END = 8 * REF_SQ_SIZE + REF_MARGIN + 1
@@ -87,30 +96,259 @@ class Diagram:
         col = ord( sq[0] ) - ord( 'a' ) # 0 to 7 left to right
         return self.coords_to_bounds( row, col )
 
+    # The board as an array of shape (8, 8, REF_SQ_SIZE, REF_SQ_SIZE, 3):
+    # the RGB pixels of each square, indexed by row (0 to 7 top to bottom
+    # as White sees it) and column, as for coords_to_pic()
+    def tiles( self ):
+        import numpy as np
+        board_size = 8 * REF_SQ_SIZE
+        img = self.img if self.img.mode == "RGB" else self.img.convert( "RGB" )
+        pixels = np.asarray( img )
+        board = pixels[1:board_size + 1, self.margin + 1:self.margin + board_size + 1]
+        tiles = board.reshape( 8, REF_SQ_SIZE, 8, REF_SQ_SIZE, 3 ).swapaxes( 1, 2 )
+        if self.flipped:
+            tiles = tiles[::-1, ::-1]
+        return tiles
+
+    # -> (FEN character of each square as an 8x8 list of lists, 8x8 array
+    # of how confident we are in each), indexed like tiles()
+    def classify_squares( self ):
+        if self.classified is None:
+            self.classified = classify_tiles( self.tiles() )
+        (chars, confidence) = self.classified
+        return (chars.tolist(), confidence)
+
     def coords_to_pic( self, row, col ):
         return self.img.crop( self.coords_to_bounds( row, col ) )
 
     def sq_to_pic( self, sq ):
         return self.img.crop( self.sq_to_bounds( sq ) )
 
-    def coords_to_char( self, row, col, ref_diag ):
-        pic = self.coords_to_pic( row, col )
-        for c in square_dict.keys():
-            for sq in square_dict[c]:
-                ref_pic = ref_diag.sq_to_pic( sq )
-                if img_equal( pic, ref_pic ):
-                    return c
-        return None
-
 # 0: W at bottom, W to move (plus all pieces as specified by square_dict)
 # 1: W at bottom, B to move
 # 2: B at bottom, W to move
 # 3: B at bottom, B to move
-ref_diagrams = [ Diagram( Image.open( "%s/reference%d.png" % (script_dir, i) ),
-                          i > 2, i % 2 == 0 ) for i in range( 1, 5 ) ]
+REF_FILES = [ os.path.join( script_dir, "reference%d.png" % i ) for i in range( 1, 5 ) ]
+
+# (flipped, black_to_move) of each reference diagram
+REF_STATES = [ (i >= 2, i % 2 == 1) for i in range( len( REF_FILES ) ) ]
+
+# The reference diagrams, read the first time they're needed. Most runs
+# only render (see sprites()) or only need what's in the reference cache,
+# so importing this module doesn't touch them.
+ref_diagrams = None
+
+def reference_diagrams():
+    global ref_diagrams
+    if ref_diagrams is None:
+        ref_diagrams = [ Diagram( Image.open( f ), *state )
+                         for (f, state) in zip( REF_FILES, REF_STATES ) ]
+    return ref_diagrams
+
+# What recognizing a diagram needs from the reference diagrams, saved so
+# that it doesn't have to decode them on every run. It's rebuilt whenever
+# any of them is modified, or what's saved changes (bump
+# REF_CACHE_VERSION). Pickles aren't always readable by the other major
+# version of Python, so each has its own.
+REF_CACHE_FILE = os.path.join( script_dir, ".reference_cache-py%d.pickle" % sys.version_info[0] )
+REF_CACHE_VERSION = 2
+
+# -> what the reference cache was built from: the modification time and
+# size of each reference diagram, and square_dict
+def reference_stamp():
+    return (REF_CACHE_VERSION,
+            [ (os.path.getmtime( f ), os.path.getsize( f )) for f in REF_FILES ],
+            sorted( square_dict.items() ))
+
+# -> { "chars": [FEN character], "tiles": array, "margins": [bytes] },
+# where the array holds every square in square_dict as it appears in
+# reference_diagrams()[0]: one row of pixel values per square, in the
+# order of chars, each character's dark square then its light one; and
+# margins holds the RGB pixels of the bottom margin of each reference
+# diagram
+def make_reference_data():
+    import numpy as np
+    chars = list( square_dict.keys() )
+    board = reference_diagrams()[0].tiles()
+    tiles = np.array( [ board[ord( '8' ) - ord( sq[1] ), ord( sq[0] ) - ord( 'a' )]
+                        for c in chars for sq in square_dict[c] ] )
+    margins = [ ref.bottom_margin_pic().convert( "RGB" ).tobytes() for ref in reference_diagrams() ]
+    return { "chars": chars, "tiles": tiles.reshape( len( tiles ), -1 ), "margins": margins }
+
+# -> the reference cache if it's current; otherwise it's computed (and
+# cached)
+ref_data = None
+
+def reference_data():
+    global ref_data
+    if ref_data is None:
+        stamp = reference_stamp()
+        try:
+            with open( REF_CACHE_FILE, "rb" ) as f:
+                cached = pickle.load( f )
+            if cached["stamp"] == stamp:
+                ref_data = cached
+        except Exception:
+            pass                # Missing, stale or unreadable; rebuild it
+        if ref_data is None:
+            ref_data = make_reference_data()
+            ref_data["stamp"] = stamp
+            try:
+                with open( REF_CACHE_FILE, "wb" ) as f:
+                    pickle.dump( ref_data, f, pickle.HIGHEST_PROTOCOL )
+            except (IOError, OSError):
+                pass            # Read-only install; just don't cache
+    return ref_data
+
+# -> (array of characters, reference tiles as float64, squared norm of
+# each tile) for classify_tiles()
+ref_tile_cache = None
+
+def reference_tiles():
+    global ref_tile_cache
+    if ref_tile_cache is None:
+        import numpy as np
+        data = reference_data()
+        tiles = data["tiles"].astype( np.float64 )
+        ref_tile_cache = (np.array( data["chars"] ), tiles, np.einsum( "ij,ij->i", tiles, tiles ))
+    return ref_tile_cache
 
-def get_margin_img( options ):
-    return ref_diagrams[2 * options.flip + options.black_to_move].img
+# { RGB pixels of the bottom margin of a reference diagram: its (flipped,
+# black_to_move) }
+ref_margin_cache = None
+
+def margin_signatures():
+    global ref_margin_cache
+    if ref_margin_cache is None:
+        ref_margin_cache = dict( zip( reference_data()["margins"], REF_STATES ) )
+    return ref_margin_cache
+
+# Bottom margin of a diagram -> (flipped, black_to_move) of the reference
+# diagram it's copied from. Exact copies are found with a single lookup of
+# their pixels; anything else (a diagram that's been resaved as a JPEG,
+# say) gets the nearest reference margin.
+def margin_state( pic ):
+    pixels = (pic if pic.mode == "RGB" else pic.convert( "RGB" )).tobytes()
+    state = margin_signatures().get( pixels )
+    if state is None:
+        import numpy as np
+        margins = reference_data()["margins"]
+        refs = np.array( [ np.frombuffer( m, np.uint8 ) for m in margins ], np.float64 )
+        dist2 = ((refs - np.frombuffer( pixels, np.uint8 )) ** 2).sum( axis=1 )
+        state = REF_STATES[int( dist2.argmin() )]
+    return state
+
+# How much the vertical position of each piece says about which way the
+# board faces. Only pawns count: they only ever move forward, whereas
+# kings wander all over the board in the endgame, where they'd often be
+# the only evidence left.
+FACING_WEIGHTS = { 'P': 1.0, 'p': -1.0 }
+
+# What it takes for the pawns to show which way a board without a margin
+# faces: at least this many of them, and a facing_score() further from 0
+# than this. Reading a board with White at the bottom as flipped is the
+# costly mistake (diag_add_margin saves the result over the original), so
+# this is set high: on made-up but plausible positions it gets that wrong
+# about 1 time in 160, and leaves about half of flipped boards unflipped.
+MIN_FACING_PAWNS = 2
+FACING_THRESHOLD = 4.0
+
+# 8x8 array of FEN characters as displayed -> how sure we are that White is
+# playing up the board: positive if White's pawns are nearer the bottom
+# than Black's, negative if they're nearer the top, 0 if there's no
+# telling. The more pawns there are, the further from 0 it tends to be.
+def facing_score( chars ):
+    import numpy as np
+    rows = np.arange( 8 )[:, None] - 3.5 # Distance below the middle of the board
+    return sum( weight * (rows * (chars == c)).sum() for (c, weight) in FACING_WEIGHTS.items() )
+
+# Array of square images of shape (..., REF_SQ_SIZE, REF_SQ_SIZE, 3) ->
+# (array of the FEN character each looks most like, array of confidence in
+# each), both of shape (...).
+#
+# Every square is compared with every reference square at once, by
+# Euclidean distance between pixel values, so squares that have been
+# recompressed or resampled still match the nearest reference. Confidence
+# is 1 - d1 / d2, where d1 is the distance to the nearest reference and d2
+# the distance to the nearest one for any other character: 1 for an exact
+# copy, near 0 when two characters fit about equally well. Squares from
+# any number of boards can be classified in a single call.
+def classify_tiles( tiles ):
+    import numpy as np
+    (ref_chars, ref_tiles, ref_tile_norms) = reference_tiles()
+    shape = tiles.shape[:-3]
+    flat = tiles.reshape( -1, ref_tiles.shape[1] ).astype( np.float64 )
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, exact for 8-bit pixels in doubles
+    dist2 = np.einsum( "ij,ij->i", flat, flat )[:, None] + ref_tile_norms - 2 * flat.dot( ref_tiles.T )
+    # Nearest of the dark and light square for each character
+    char_dist2 = dist2.reshape( len( flat ), len( ref_chars ), -1 ).min( axis=2 )
+    best = char_dist2.argmin( axis=1 )
+    (nearest, other) = np.sqrt( np.maximum( np.partition( char_dist2, 1, axis=1 )[:, :2], 0 ) ).T
+    with np.errstate( divide="ignore", invalid="ignore" ):
+        confidence = np.where( other > 0, 1 - nearest / other, 1.0 )
+    return (ref_chars[best].reshape( shape ), confidence.reshape( shape ))
+
+# All the art fen_to_image() needs, in one file: a row with the dark and
+# light square for each character of square_dict (in SPRITE_CHARS order),
+# then under it the left margins of the four reference diagrams side by
+# side, then the bottom margins, one under the other, to the right of
+# those. Margins are in ref_diagrams order. Regenerate it with
+# save_sprite_atlas() if the reference art changes.
+SPRITE_FILE = "sprites.png"
+SPRITE_CHARS = "PRNBQKprnbqk "
+MARGIN_LENGTH = 8 * REF_SQ_SIZE + REF_MARGIN # Long side of a margin strip
+
+# (x, y) of the top left corner of each kind of sprite in the atlas
+def tile_sprite_pos( piece, color ):
+    return (REF_SQ_SIZE * (2 * SPRITE_CHARS.index( piece ) + color), 0)
+
+def left_margin_sprite_pos( i ):
+    return (REF_MARGIN * i, REF_SQ_SIZE)
+
+def bottom_margin_sprite_pos( i ):
+    return (REF_MARGIN * 4, REF_SQ_SIZE + REF_MARGIN * i)
+
+# Where the margins are in a diagram with margins, as PIL boxes
+def left_margin_box():
+    return (1, 1, REF_MARGIN + 1, MARGIN_LENGTH + 1)
+
+def bottom_margin_box():
+    return (1, MARGIN_LENGTH + 1 - REF_MARGIN, MARGIN_LENGTH + 1, MARGIN_LENGTH + 1)
+
+# Build the sprite atlas from the reference diagrams and save it
+def save_sprite_atlas():
+    atlas = Image.new( "RGB", (REF_SQ_SIZE * 2 * len( SPRITE_CHARS ),
+                               REF_SQ_SIZE + MARGIN_LENGTH) )
+    for piece in SPRITE_CHARS:
+        for color in range( 2 ):
+            atlas.paste( reference_diagrams()[0].sq_to_pic( square_dict[piece][color] ),
+                         tile_sprite_pos( piece, color ) )
+    for (i, ref) in enumerate( reference_diagrams() ):
+        atlas.paste( ref.img.crop( left_margin_box() ), left_margin_sprite_pos( i ) )
+        atlas.paste( ref.img.crop( bottom_margin_box() ), bottom_margin_sprite_pos( i ) )
+    atlas.save( os.path.join( script_dir, SPRITE_FILE ) )
+
+# Sprites cut out of the atlas, read the first time they're needed:
+# { "tiles": { (FEN character, color): square },
+#   "left_margins": [margin for each of ref_diagrams],
+#   "bottom_margins": [likewise] }
+sprite_cache = None
+
+def sprites():
+    global sprite_cache
+    if sprite_cache is None:
+        atlas = Image.open( os.path.join( script_dir, SPRITE_FILE ) ).convert( "RGB" )
+        def cut( pos, width, height ):
+            return atlas.crop( (pos[0], pos[1], pos[0] + width, pos[1] + height) )
+        sprite_cache = {
+            "tiles": dict( ((piece, color), cut( tile_sprite_pos( piece, color ),
+                                                  REF_SQ_SIZE, REF_SQ_SIZE ))
+                           for piece in SPRITE_CHARS for color in range( 2 ) ),
+            "left_margins": [ cut( left_margin_sprite_pos( i ), REF_MARGIN, MARGIN_LENGTH )
+                              for i in range( 4 ) ],
+            "bottom_margins": [ cut( bottom_margin_sprite_pos( i ), MARGIN_LENGTH, REF_MARGIN )
+                                for i in range( 4 ) ] }
+    return sprite_cache
 
 # 0 = dark, 1 = light
 def square_color( col, row ):
@@ -118,7 +356,7 @@ def square_color( col, row ):
 
 def add_square( img, col, row, piece, options ):
     color = square_color( col, row )
-    sq_pic = ref_diagrams[0].sq_to_pic( square_dict[piece][color] )
+    sq_pic = sprites()["tiles"][(piece, color)]
     margin = REF_MARGIN if options.show_side else 0
     display_col = 7 - col if options.flip else col
     display_row = 7 - row if options.flip else row
@@ -163,22 +401,18 @@ def fen_to_image( fen, options ):
     return img
 
 def add_margins( img, options ):
-    MARGIN_END = 8 * REF_SQ_SIZE + REF_MARGIN + 1
-    margin_img = get_margin_img( options )
-    left_margin_coords = (1, 1, REF_MARGIN + 1, MARGIN_END)
-    left_margin = margin_img.crop( left_margin_coords )
-    img.paste( left_margin, left_margin_coords )
-    bottom_margin_coords = (1, MARGIN_END - REF_MARGIN, MARGIN_END, MARGIN_END)
-    bottom_margin = margin_img.crop( bottom_margin_coords )
-    img.paste( bottom_margin, bottom_margin_coords )
+    i = 2 * options.flip + options.black_to_move # Index into ref_diagrams
+    img.paste( sprites()["left_margins"][i], left_margin_box() )
+    img.paste( sprites()["bottom_margins"][i], bottom_margin_box() )
     return img
 
 def diag_to_fen( diag ):
+    (chars, confidence) = diag.classify_squares()
     fen_str = ""
     num_spaces = 0
     for row in range( 8 ):
         for col in range( 8 ):
-            c = diag.coords_to_char( row, col, ref_diagrams[0] )
+            c = chars[row][col]
             if c == " ":
                 num_spaces += 1
             else:
@@ -198,5 +432,16 @@ def diag_to_fen( diag ):
     fen_str += " KQkq - 0 1"    # I don't really care about this
     return fen_str
 
+# -> [(square like 'e4', confidence)] for each square of the diagram that
+# was recognized with less than LOW_CONFIDENCE
+def doubtful_squares( diag ):
+    (chars, confidence) = diag.classify_squares()
+    return [ ("%s%d" % (chr( ord( 'a' ) + col ), 8 - row), float( confidence[row, col] ))
+             for row in range( 8 ) for col in range( 8 )
+             if confidence[row, col] < LOW_CONFIDENCE ]
+
 def image_to_fen( img ):
     return diag_to_fen( Diagram( img ) )
+
+if __name__ == "__main__":
+    save_sprite_atlas()
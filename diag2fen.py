@@ -10,6 +10,11 @@ parser.add_argument( "input_name",
 global_options = parser.parse_args()
 
 img = Image.open( global_options.input_name )
-fen_str = chessdiag.image_to_fen( img )
+diag = chessdiag.Diagram( img )
+fen_str = chessdiag.diag_to_fen( diag )
 pyperclip.copy( fen_str )
 print fen_str
+if diag.facing_guessed:
+    print "No margin, and not enough pawns to tell which way the board faces; assuming White is at the bottom"
+for (sq, confidence) in chessdiag.doubtful_squares( diag ):
+    print "Not sure about %s (confidence %.2f)" % (sq, confidence)
@@ -1,8 +1,11 @@
 import argparse
 import chessdiag
 import glob
+import hashlib
+import multiprocessing
 import os.path
 import re
+import sqlite3
 from PIL import Image
 
 parser = argparse.ArgumentParser( description="Read a file with a chess diagram, "
@@ -14,8 +17,10 @@ parser.add_argument( "--input_dir",
                      help="Directory to read files from" )
 parser.add_argument( "--ref_file",
                      help="Text file exported from Mnemosyne" )
-                     
-global_options = parser.parse_args()
+parser.add_argument( "-j",
+                     "--processes",
+                     type=int,
+                     help="Number of processes to use with --input_dir (default: one per CPU)" )
 
 str_to_side = {
     'B':     'Black',
@@ -27,41 +32,195 @@ str_to_side = {
 to_play_re = re.compile( r"(\w+) to (play|move)" )
 img_url_re = re.compile( r'<img src="(.*?)">' )
 
-# Generate mapping of image name to its line from the database file
-img_to_line = {}
-for l in open( global_options.ref_file ):
-    m = img_url_re.search( l )
-    if m:
-        img_to_line[m.group( 1 )] = l
+# Index of the images in a reference file exported from Mnemosyne, kept
+# in <ref_file>.index next to it: for each image, the side to play in the
+# line that shows it, and where that line starts. The export can be huge,
+# so the index is only rebuilt when the export's size or modification
+# time changes, and is queried one image at a time rather than loaded.
+class RefIndex():
+    def __init__( self, ref_file ):
+        self.ref_file = ref_file
+        try:
+            self.db = sqlite3.connect( ref_file + ".index" )
+            self.db.execute( "CREATE TABLE IF NOT EXISTS stamp (size INTEGER, mtime REAL)" )
+        except sqlite3.Error:
+            self.db = sqlite3.connect( ":memory:" ) # Can't write next to the export
+            self.db.execute( "CREATE TABLE stamp (size INTEGER, mtime REAL)" )
+        self.db.text_factory = str # Names are as read from the export
+        self.db.execute( "CREATE TABLE IF NOT EXISTS images "
+                         "(name TEXT PRIMARY KEY, side TEXT, offset INTEGER NOT NULL)" )
+        stamp = (os.path.getsize( ref_file ), os.path.getmtime( ref_file ))
+        if self.db.execute( "SELECT size, mtime FROM stamp" ).fetchone() != stamp:
+            self.rebuild( stamp )
 
-def process_file( fname, output_dir ):
+    # Read through the export once and index every image in it. If an
+    # image appears in more than one line, the last one counts.
+    def rebuild( self, stamp ):
+        with self.db:
+            self.db.execute( "DELETE FROM images" )
+            self.db.executemany( "INSERT OR REPLACE INTO images VALUES (?, ?, ?)",
+                                 self.scan() )
+            self.db.execute( "DELETE FROM stamp" )
+            self.db.execute( "INSERT INTO stamp VALUES (?, ?)", stamp )
+
+    # -> iterator of (image name, 'White', 'Black' or None, offset of line)
+    def scan( self ):
+        offset = 0
+        with open( self.ref_file, "rb" ) as f:
+            for l in f:
+                m = img_url_re.search( l )
+                if m:
+                    side = to_play_re.search( l )
+                    # "Who to move?" and the like don't say
+                    yield (m.group( 1 ), str_to_side.get( side.group( 1 ) ) if side else None, offset)
+                offset += len( l )
+
+    # Image name -> (side to play or None, offset of its line), or None if
+    # it isn't in the export
+    def lookup( self, img_name ):
+        return self.db.execute( "SELECT side, offset FROM images WHERE name = ?",
+                                (img_name,) ).fetchone()
+
+    def close( self ):
+        self.db.close()
+
+# What became of a file
+ADDED = "added"                 # Margin added and file saved
+HAD_MARGIN = "had margin"       # Left alone
+NOT_FOUND = "not found"         # Not in the reference file
+NO_SIDE = "no side"             # Reference file doesn't say who's to play
+FAILED = "failed"               # Couldn't read the diagram
+UNCHANGED = "unchanged"         # Same as when last done; skipped
+
+# Outcomes after which there's nothing more to do for a file until it
+# changes
+FINISHED = (ADDED, HAD_MARGIN)
+
+def file_hash( fname ):
+    with open( fname, "rb" ) as f:
+        return hashlib.sha1( f.read() ).hexdigest()
+
+# Name of the image in the reference file
+def image_name( fname ):
+    return fname[fname.find( "images" ):].replace( "\\", "/" )
+
+# Reference file line for `fname` -> 'White' or 'Black', NOT_FOUND or NO_SIDE
+def side_to_play( fname, ref_index ):
+    found = ref_index.lookup( image_name( fname ) )
+    if found is None:
+        return NOT_FOUND
+    return found[0] or NO_SIDE
+
+# Add a margin to the diagram in `fname` if it doesn't have one, saving it
+# in output_dir. Returns ADDED or HAD_MARGIN.
+def add_margin( fname, side, output_dir ):
     img = Image.open( fname )
     name = os.path.realpath( fname )
-    img_name = fname[fname.find( "images" ):].replace( "\\", "/" )
-    side = 'White'
-    if img_to_line.has_key( img_name ):
-        l = img_to_line[img_name]
-        m = to_play_re.search( l )
-        if m:
-            side = str_to_side[ m.group( 1 ) ]
-            diag = chessdiag.Diagram( img )
-            fen_str = chessdiag.diag_to_fen( diag )
-            # Only resave the file if it didn't have a margin already
-            if not diag.has_margin:
-                diag.black_to_move = (side == 'Black')
-                options = argparse.Namespace()
-                setattr( options, "show_side", True )
-                setattr( options, "black_to_move", diag.black_to_move )
-                setattr( options, "flip", diag.flipped )
-                out_img = chessdiag.fen_to_image( fen_str, options )
-                out_img.save( os.path.join( output_dir, os.path.basename( name ) ) )
-        else:
-            print "Couldn't find side to play for %s in %s" % (fname, global_options.ref_file)
+    diag = chessdiag.Diagram( img )
+    fen_str = chessdiag.diag_to_fen( diag )
+    # Only resave the file if it didn't have a margin already
+    if diag.has_margin:
+        return HAD_MARGIN
+    diag.black_to_move = (side == 'Black')
+    options = argparse.Namespace()
+    setattr( options, "show_side", True )
+    setattr( options, "black_to_move", diag.black_to_move )
+    setattr( options, "flip", diag.flipped )
+    out_img = chessdiag.fen_to_image( fen_str, options )
+    out_img.save( os.path.join( output_dir, os.path.basename( name ) ) )
+    return ADDED
+
+def report( fname, outcome, ref_file ):
+    if outcome == NOT_FOUND:
+        print "Couldn't find %s in %s" % (fname, ref_file)
+    elif outcome == NO_SIDE:
+        print "Couldn't find side to play for %s in %s" % (fname, ref_file)
+
+def process_file( fname, output_dir, ref_index, ref_file ):
+    side = side_to_play( fname, ref_index )
+    if side in (NOT_FOUND, NO_SIDE):
+        report( fname, side, ref_file )
     else:
-        print "Couldn't find %s in %s" % (fname, global_options.ref_file)
+        add_margin( fname, side, output_dir )
+
+MANIFEST_FILE = ".add_margin.sqlite"
+
+# Record of what each run over a directory did to each file, and the hash
+# of the file's contents afterwards, so that a later (or interrupted) run
+# can skip the files that are already done
+class Manifest():
+    def __init__( self, directory ):
+        self.db = sqlite3.connect( os.path.join( directory, MANIFEST_FILE ) )
+        self.db.execute( "CREATE TABLE IF NOT EXISTS files "
+                         "(name TEXT PRIMARY KEY, hash TEXT, outcome TEXT NOT NULL)" )
+
+    # -> { filename: hash } of files that were finished
+    def finished( self ):
+        rows = self.db.execute( "SELECT name, hash FROM files WHERE outcome IN (?, ?)", FINISHED )
+        return dict( rows.fetchall() )
+
+    # Record [(filename, hash, outcome)]
+    def record( self, entries ):
+        with self.db:
+            self.db.executemany( "INSERT OR REPLACE INTO files VALUES (?, ?, ?)", entries )
+
+    def close( self ):
+        self.db.close()
+
+# Work on one file of a directory in a worker process: (filename, side to
+# play, output directory, hash when last finished or None) -> (filename,
+# hash now, outcome, error message or None)
+def directory_job( job ):
+    (fname, side, output_dir, done_hash) = job
+    try:
+        before = file_hash( fname )
+        if before == done_hash:
+            return (fname, before, UNCHANGED, None)
+        if side in (NOT_FOUND, NO_SIDE):
+            return (fname, before, side, None)
+        outcome = add_margin( fname, side, output_dir )
+        return (fname, file_hash( fname ), outcome, None)
+    except Exception as e:
+        return (fname, None, FAILED, str( e ))
+
+# How many files to process between saving progress
+MANIFEST_BATCH = 64
+
+def process_dir( input_dir, ref_index, ref_file, processes ):
+    manifest = Manifest( input_dir )
+    finished = manifest.finished()
+    fnames = sorted( glob.glob( os.path.join( input_dir, "*.png" ) ) )
+    jobs = [ (fname, side_to_play( fname, ref_index ), input_dir,
+              finished.get( os.path.basename( fname ) ))
+             for fname in fnames ]
+
+    counts = {}                 # outcome -> number of files
+    entries = []                # Manifest entries not yet saved
+    pool = multiprocessing.Pool( processes )
+    for (i, (fname, hash, outcome, error)) in enumerate( pool.imap_unordered( directory_job, jobs, 8 ) ):
+        counts[outcome] = counts.get( outcome, 0 ) + 1
+        report( fname, outcome, ref_file )
+        if error:
+            print "Couldn't process %s: %s" % (fname, error)
+        if outcome != UNCHANGED:
+            entries.append( (os.path.basename( fname ), hash, outcome) )
+        if len( entries ) >= MANIFEST_BATCH:
+            manifest.record( entries )
+            entries = []
+        if (i + 1) % 1000 == 0:
+            print "%d of %d files processed" % (i + 1, len( jobs ))
+    manifest.record( entries )
+    pool.close()
+    pool.join()
+    manifest.close()
+    print ", ".join( "%d %s" % (counts[k], k) for k in sorted( counts ) )
 
-if global_options.input_dir:
-    for fname in glob.glob( os.path.join( global_options.input_dir, "*.png" ) ):
-        process_file( fname, global_options.input_dir )
-elif global_options.input_file:
-    process_file( global_options.input_file, "." )
+if __name__ == "__main__":
+    global_options = parser.parse_args()
+    ref_index = RefIndex( global_options.ref_file )
+    if global_options.input_dir:
+        process_dir( global_options.input_dir, ref_index, global_options.ref_file,
+                     global_options.processes )
+    elif global_options.input_file:
+        process_file( global_options.input_file, ".", ref_index, global_options.ref_file )
+    ref_index.close()
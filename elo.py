@@ -0,0 +1,255 @@
+# Vectorized Elo performance-rating arithmetic
+#
+# perf.py solves one window of games at a time in pure Python. The
+# functions here work on NumPy arrays instead, so that every window
+# position of a player's history can be solved in one batch.
+
+import math
+import numpy as np
+import profiling
+
+# Entries of the window matrix solved at once; bounds memory use to about
+# this many floats per temporary
+BLOCK_SIZE = 1 << 19
+
+# When solving windows that slide along a history, solve every this many
+# from scratch and start the rest from their neighbours' answers
+WARM_START_STRIDE = 8
+
+# perf_rating() solves problems of up to this many games in plain Python:
+# for a tournament's worth of games, NumPy's overhead on each call costs
+# far more than the arithmetic
+SCALAR_MAX_GAMES = 64
+
+# I'm rated d points above the other player; what's my EV? `d` may be an
+# array.
+def expected_values( d ):
+    return 1.0 / (1.0 + np.power( 10.0, -d / 400.0 ))
+
+# For each row, find the rating whose weighted expected score against that
+# row's opponents equals targets[row]. `opp_ratings` and `weights` are 2-D
+# with one row per problem; entries with zero weight are padding and are
+# ignored. Returns (ratings, iterations), both with one entry per row.
+# `initial`, if given, holds a starting guess for each row; a good one
+# (say, the answer to a similar problem) saves iterations. Rows that
+# haven't converged after `max_iterations` (as when an input isn't finite)
+# get NaN rather than wherever the iteration had got to.
+#
+# Each iteration computes the expected score and its derivative,
+# ln(10)/400 * sum(w * p * (1 - p)), from the same expected_values() pass
+# and takes a Newton step. Every evaluation also narrows a bracket around
+# the answer; a step that would leave the bracket bisects it instead, or
+# moves 400 points towards the answer while the bracket is still open on
+# that side. A Newton step of less than `step_tolerance` points is taken
+# as the answer without evaluating it again: near the answer each step's
+# error is of the order of its square. Rows where every game was lost
+# (won) get the lowest (highest) opponent rating -400 (+400), as
+# accurate_perf_rating_raw_weighted() does.
+def solve_perf_ratings( opp_ratings, weights, targets,
+                        tolerance=1e-6, max_iterations=100, initial=None, step_tolerance=1e-3 ):
+    opp_ratings = np.asarray( opp_ratings, dtype=float )
+    weights = np.asarray( weights, dtype=float )
+    targets = np.asarray( targets, dtype=float )
+    present = weights > 0
+    lowest = np.where( present, opp_ratings, np.inf ).min( axis=1 )
+    highest = np.where( present, opp_ratings, -np.inf ).max( axis=1 )
+    total_weight = weights.sum( axis=1 )
+    all_lost = targets <= 0
+    all_won = targets >= total_weight
+
+    # Unless told otherwise, start by guessing our rating is the weighted
+    # average of our opponents'
+    if initial is None:
+        ratings = (weights * opp_ratings).sum( axis=1 ) / np.where( total_weight > 0, total_weight, 1 )
+    else:
+        ratings = np.array( initial, dtype=float )
+    ratings[all_lost] = lowest[all_lost] - 400
+    ratings[all_won] = highest[all_won] + 400
+    iterations = np.zeros( len( ratings ), dtype=int )
+
+    rows = np.flatnonzero( ~(all_lost | all_won) )
+    x = ratings[rows]
+    lo = np.full( len( rows ), -np.inf )
+    hi = np.full( len( rows ), np.inf )
+    slope_scale = np.log( 10.0 ) / 400.0
+    for i in range( max_iterations ):
+        if len( rows ) == 0:
+            break
+        w = weights[rows]
+        p = expected_values( x[:, None] - opp_ratings[rows] )
+        error = (w * p).sum( axis=1 ) - targets[rows]
+        slope = slope_scale * (w * p * (1 - p)).sum( axis=1 )
+        iterations[rows] += 1
+
+        done = (np.abs( error ) < tolerance) | (hi - lo < tolerance)
+        ratings[rows[done]] = x[done]
+        hi = np.where( error > 0, x, hi )
+        lo = np.where( error > 0, lo, x )
+
+        with np.errstate( divide="ignore", invalid="ignore" ):
+            step = x - error / slope
+        overshot = ~np.isfinite( step ) | (step <= lo) | (step >= hi)
+        bracketed = np.isfinite( lo ) & np.isfinite( hi )
+        fallback = np.where( bracketed, (lo + hi) / 2,
+                             np.where( error > 0, x - 400, x + 400 ) )
+        landed = ~done & ~overshot & (np.abs( step - x ) < step_tolerance)
+        ratings[rows[landed]] = step[landed]
+        done |= landed
+        x = np.where( overshot, fallback, step )
+
+        keep = ~done
+        rows, x, lo, hi = rows[keep], x[keep], lo[keep], hi[keep]
+    ratings[rows] = np.nan
+    profiling.count( "solver_rows", len( ratings ) )
+    profiling.count( "solver_iterations", int( iterations.sum() ) )
+    return (ratings, iterations)
+
+# solve_perf_ratings() of one problem, given as sequences, in plain
+# Python: the same iteration, so the same answer. Returns (rating,
+# iterations). Raises OverflowError if the ratings are too far apart to
+# work with as floats.
+def solve_one( opp_ratings, weights, target,
+               tolerance=1e-6, max_iterations=100, step_tolerance=1e-3 ):
+    games = [ (float( r ), float( w )) for (r, w) in zip( opp_ratings, weights ) if w > 0 ]
+    total_weight = sum( w for (r, w) in games )
+    if target <= 0:
+        return (min( r for (r, w) in games ) - 400, 0)
+    if target >= total_weight:
+        return (max( r for (r, w) in games ) + 400, 0)
+
+    x = sum( w * r for (r, w) in games ) / total_weight
+    lo = -math.inf
+    hi = math.inf
+    slope_scale = math.log( 10.0 ) / 400.0
+    for i in range( 1, max_iterations + 1 ):
+        ps = [ (w, 1.0 / (1.0 + 10.0 ** ((r - x) / 400.0))) for (r, w) in games ]
+        error = sum( w * p for (w, p) in ps ) - target
+        slope = slope_scale * sum( w * p * (1 - p) for (w, p) in ps )
+        if abs( error ) < tolerance or hi - lo < tolerance:
+            return (x, i)
+        if error > 0:
+            hi = x
+        else:
+            lo = x
+        step = x - error / slope if slope else math.nan
+        if not math.isfinite( step ) or step <= lo or step >= hi:
+            if math.isfinite( lo ) and math.isfinite( hi ):
+                x = (lo + hi) / 2
+            else:
+                x = x - 400 if error > 0 else x + 400
+        elif abs( step - x ) < step_tolerance:
+            return (step, i)
+        else:
+            x = step
+    return (math.nan, max_iterations)
+
+# Rating that would result in a total score of `score` against opponents
+# rated `opp_ratings`, with games weighted by `weights` (default: equally).
+# The scalar entry point to solve_perf_ratings(); accepts lists or arrays.
+# Problems of up to SCALAR_MAX_GAMES games go to solve_one().
+def perf_rating( opp_ratings, score, weights=None ):
+    if 0 < len( opp_ratings ) <= SCALAR_MAX_GAMES:
+        try:
+            (rating, iterations) = solve_one( opp_ratings,
+                                              [ 1 ] * len( opp_ratings ) if weights is None else weights,
+                                              float( score ) )
+            profiling.count( "solver_rows" )
+            profiling.count( "solver_iterations", iterations )
+            return rating
+        except (OverflowError, ValueError, ZeroDivisionError):
+            pass                # Leave the odd cases to NumPy
+    opp_ratings = np.asarray( opp_ratings, dtype=float )[None, :]
+    if weights is None:
+        weights = np.ones_like( opp_ratings )
+    else:
+        weights = np.asarray( weights, dtype=float )[None, :]
+    (ratings, _) = solve_perf_ratings( opp_ratings, weights, np.array( [score], dtype=float ) )
+    return float( ratings[0] )
+
+# Gaussian weight, of standard deviation `std_dev`, of each of `offsets`
+def gaussian( offsets, std_dev ):
+    return np.exp( -np.asarray( offsets, dtype=float )**2 / (2.0 * std_dev**2) )
+
+# solve_perf_ratings() for rows whose answers change only a little from
+# one row to the next, as when a window slides along a history: every
+# WARM_START_STRIDE-th row (and the last) is solved from scratch, and the
+# rest starting from the line between those answers, which usually takes
+# them two Newton steps. Returns (ratings, iterations).
+def solve_sliding( opp_ratings, weights, targets ):
+    n = len( targets )
+    anchor = np.zeros( n, dtype=bool )
+    anchor[::WARM_START_STRIDE] = True
+    anchor[-1] = True
+    (anchors, rest) = (np.flatnonzero( anchor ), np.flatnonzero( ~anchor ))
+    ratings = np.empty( n )
+    iterations = np.empty( n, dtype=int )
+    (ratings[anchors], iterations[anchors]) = solve_perf_ratings( opp_ratings[anchors], weights[anchors],
+                                                                  targets[anchors] )
+    if len( rest ):
+        (ratings[rest], iterations[rest]) = solve_perf_ratings(
+            opp_ratings[rest], weights[rest], targets[rest],
+            initial=np.interp( rest, anchors, ratings[anchors] ) )
+    return (ratings, iterations)
+
+# Recent performance rating around each game of a history. Entry x of the
+# result is the rating for the window of games [x - window_size,
+# x + window_size), each weighted by a Gaussian of standard deviation
+# `std_dev` centred on game x; x runs from 0 to len(opp_ratings)
+# inclusive.
+#
+# Each window is solved by solve_perf_ratings(), so its expected score
+# matches its weighted score to within a millionth of a point. Windows
+# where every game was won (lost) get the highest (lowest) opponent rating
+# +400 (-400).
+#
+# The windows are views into the history, padded with weightless games at
+# either end, that slide along it a game at a time, so the weights are
+# just the one kernel masked by where there are games.
+def window_perf_ratings( opp_ratings, scores, window_size=60, std_dev=20 ):
+    opp_ratings = np.asarray( opp_ratings, dtype=float )
+    scores = np.asarray( scores, dtype=float )
+    n = len( opp_ratings )
+    width = 2 * window_size
+    kernel = gaussian( np.arange( -window_size, window_size ), std_dev )
+    pad = np.zeros( window_size )
+    # Row x of each covers games [x - window_size, x + window_size)
+    (opp_windows, score_windows, present) = [
+        np.lib.stride_tricks.sliding_window_view( np.concatenate( (pad, a, pad) ), width )
+        for a in (opp_ratings, scores, np.ones( n )) ]
+
+    ans = np.empty( n + 1 )
+    rows = max( 1, BLOCK_SIZE // width )
+    for block_begin in range( 0, n + 1, rows ):
+        block = slice( block_begin, min( n + 1, block_begin + rows ) )
+        weights = kernel * present[block]
+        targets = (weights * score_windows[block]).sum( axis=1 )
+        (ans[block], _) = solve_sliding( opp_windows[block], weights, targets )
+    return ans
+
+# Like window_perf_ratings(), but over windows of calendar time: entry x
+# of the result is the rating for the games played within `days` days of
+# game x (for x = len(opp_ratings), of the last game), each weighted by a
+# Gaussian of standard deviation `std_dev` days (default: days / 3).
+# `dates` are day numbers, in order.
+def date_window_perf_ratings( opp_ratings, scores, dates, days=365, std_dev=None ):
+    opp_ratings = np.asarray( opp_ratings, dtype=float )
+    scores = np.asarray( scores, dtype=float )
+    dates = np.asarray( dates, dtype=float )
+    std_dev = std_dev or days / 3.0
+    n = len( opp_ratings )
+    centres = dates[np.minimum( np.arange( n + 1 ), n - 1 )]
+    first = np.searchsorted( dates, centres - days, "left" )
+    end = np.searchsorted( dates, centres + days, "right" )
+
+    ans = np.empty( n + 1 )
+    rows = max( 1, BLOCK_SIZE // int( (end - first).max() ) )
+    for block_begin in range( 0, n + 1, rows ):
+        block = slice( block_begin, min( n + 1, block_begin + rows ) )
+        width = int( (end[block] - first[block]).max() )
+        indices = first[block, None] + np.arange( width )
+        in_window = indices < end[block, None]
+        indices = np.minimum( indices, n - 1 )
+        weights = np.where( in_window, gaussian( dates[indices] - centres[block, None], std_dev ), 0.0 )
+        targets = (weights * scores[indices]).sum( axis=1 )
+        (ans[block], _) = solve_sliding( opp_ratings[indices], weights, targets )
+    return ans
@@ -1,8 +1,14 @@
 import argparse
 import chessdiag
-import filecmp
+import copy
+import glob
+import multiprocessing
 import os.path
 import pyperclip
+import re
+import sqlite3
+import sys
+from PIL import Image
 
 # import win32clipboard
 # import win32con
@@ -19,7 +25,9 @@ import pyperclip
 parser = argparse.ArgumentParser( description="Output a chessboard graphic corresponding to "
                                   "the FEN string currently occupying the clipboard." )
 parser.add_argument( "output_name",
-                     help="Base filename to output to (.png will be appended)")
+                     nargs="?",
+                     help="Base filename to output to (.png will be appended). "
+                     "In batch mode, the prefix for diagrams that aren't given a name")
 parser.add_argument( "-b",
                      "--black_to_move",
                      help="To-move indicator shows that black is to move",
@@ -36,19 +44,223 @@ parser.add_argument( "-o",
                      "--override",
                      help="Allow writing over files or creating duplicate diagrams",
                      action="store_true" )
-global_options = parser.parse_args()
-
-str = pyperclip.paste()
-print "Using %s" % str
-out_img = chessdiag.fen_to_image( str, global_options )
-                    
-ref_filename = ".last.png"
-output_name = "%s.png" % global_options.output_name
-if not global_options.override and (os.path.exists( output_name )):
-    print "%s already exists" % output_name
-else:
-    out_img.save( output_name )
-    if os.path.exists( ref_filename ) and filecmp.cmp( output_name, ref_filename ):
-        print "Saved duplicate file"
+parser.add_argument( "-B",
+                     "--batch",
+                     help="Render every FEN in this file ('-' for standard input) instead of "
+                     "the clipboard. Each line is a FEN, optionally followed by a tab or comma "
+                     "and the base filename to output to." )
+parser.add_argument( "-j",
+                     "--processes",
+                     type=int,
+                     help="Number of processes to render with in batch mode (default: one per CPU)" )
+parser.add_argument( "--rebuild_index",
+                     metavar="DIR",
+                     help="Rebuild the duplicate index of the diagrams in DIR by reading "
+                     "every PNG there, then exit" )
+
+INDEX_FILE = ".diagrams.sqlite"
+
+# Persistent mapping of diagram_key() to the diagram file showing it, kept
+# in each directory diagrams are written to, so that duplicates can be
+# found before rendering anything
+class DiagramIndex():
+    def __init__( self, directory ):
+        self.directory = directory
+        self.db = sqlite3.connect( os.path.join( directory, INDEX_FILE ) )
+        self.db.executescript( "CREATE TABLE IF NOT EXISTS diagrams "
+                               "(key TEXT PRIMARY KEY, filename TEXT NOT NULL);"
+                               "CREATE INDEX IF NOT EXISTS diagrams_filename "
+                               "ON diagrams (filename);" )
+
+    # key -> path of the diagram file with that key, or None if there
+    # isn't one (any more)
+    def lookup( self, key ):
+        row = self.db.execute( "SELECT filename FROM diagrams WHERE key = ?", (key,) ).fetchone()
+        if row:
+            path = os.path.join( self.directory, row[0] )
+            if os.path.exists( path ):
+                return path
+        return None
+
+    # Record [(key, path)], forgetting whatever else was in those files
+    def add( self, entries ):
+        with self.db:
+            for (key, path) in entries:
+                filename = os.path.basename( path )
+                self.db.execute( "DELETE FROM diagrams WHERE filename = ?", (filename,) )
+                self.db.execute( "INSERT OR REPLACE INTO diagrams VALUES (?, ?)", (key, filename) )
+
+    def clear( self ):
+        with self.db:
+            self.db.execute( "DELETE FROM diagrams" )
+
+    def close( self ):
+        self.db.close()
+
+# Open indexes by directory
+indexes = {}
+
+# Filename -> DiagramIndex of its directory
+def index_for( path ):
+    directory = os.path.dirname( path ) or "."
+    if directory not in indexes:
+        indexes[directory] = DiagramIndex( directory )
+    return indexes[directory]
+
+# Render one FEN and save it, the single-diagram way: don't overwrite
+# anything, or save a diagram we already have
+def draw_fen( fen, options ):
+    print "Using %s" % fen
+    output_name = "%s.png" % options.output_name
+    index = index_for( output_name )
+    key = diagram_key( fen, options )
+    duplicate = index.lookup( key )
+    if not options.override and os.path.exists( output_name ):
+        print "%s already exists" % output_name
+    elif not options.override and duplicate:
+        print "Same diagram as %s" % duplicate
+    else:
+        chessdiag.fen_to_image( fen, options ).save( output_name )
+        index.add( [ (key, output_name) ] )
+
+# Lines of a batch file -> [(line number, FEN, base filename)]. Lines
+# without a name are named after `prefix` and their line number.
+def read_batch( lines, prefix ):
+    jobs = []
+    for (i, l) in enumerate( lines, 1 ):
+        l = l.strip()
+        if not l:
+            continue
+        for sep in "\t,":
+            if sep in l:
+                (fen, name) = [ x.strip() for x in l.rsplit( sep, 1 ) ]
+                break
+        else:
+            (fen, name) = (l, "%s%04d" % (prefix, i))
+        jobs.append( (i, fen, name) )
+    return jobs
+
+# Piece placement with runs of empty squares written in full, so that
+# e.g. "44" and "8" come out the same
+def expand_placement( placement ):
+    return re.sub( r"\d", lambda m: " " * int( m.group( 0 ) ), placement )
+
+# What makes two diagrams look the same: the position, and how it's shown.
+# Only diagrams with a margin show whose move it is.
+def diagram_key( fen, options ):
+    fields = fen.split()
+    black_to_move = options.black_to_move or (len( fields ) > 1 and fields[1] == "b")
+    return "%s %s %s %s" % (expand_placement( fields[0] ),
+                            "margin" if options.show_side else "-",
+                            "flip" if options.flip else "-",
+                            ("b" if black_to_move else "w") if options.show_side else "-")
+
+# Key of the diagram in an existing image file
+def image_key( path ):
+    diag = chessdiag.Diagram( Image.open( path ) )
+    fen = chessdiag.diag_to_fen( diag )
+    options = argparse.Namespace( show_side=diag.has_margin, flip=diag.flipped,
+                                  black_to_move=diag.black_to_move )
+    return diagram_key( fen, options )
+
+# Forget what the index for `directory` says and read every diagram there
+def rebuild_index( directory ):
+    index = DiagramIndex( directory )
+    index.clear()
+    entries = []
+    for path in sorted( glob.glob( os.path.join( directory, "*.png" ) ) ):
+        try:
+            entries.append( (image_key( path ), path) )
+        except Exception as e:
+            print "Skipping %s: %s" % (path, e)
+    index.add( entries )
+    index.close()
+    print "Indexed %d diagrams in %s" % (len( entries ), directory)
+
+# Render one batch job in a worker process: (line number, key, FEN,
+# filename, options) -> (line number, key, filename, error message or
+# None)
+def render_job( job ):
+    (line, key, fen, output_name, options) = job
+    try:
+        chessdiag.fen_to_image( fen, options ).save( output_name )
+        return (line, key, output_name, None)
+    except Exception as e:
+        return (line, key, output_name, "%s: %s" % (type( e ).__name__, e))
+
+# How many diagrams to render between saving index entries
+INDEX_BATCH = 256
+
+# Render every FEN listed in the batch file, skipping, unless overriding,
+# any that would come out the same as an earlier one or one that's
+# already been saved, and any whose output file already exists
+def draw_batch( options ):
+    if options.batch == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open( options.batch ) as f:
+            lines = f.readlines()
+    prefix = (options.output_name or "diagram") + "-"
+
+    todo = []
+    names = set()               # Filenames in todo
+    seen = {}                   # diagram_key -> (line number, filename)
+    for (line, fen, name) in read_batch( lines, prefix ):
+        output_name = "%s.png" % name
+        key = diagram_key( fen, options )
+        if key in seen and not options.override:
+            print "Line %d: same diagram as line %d (%s)" % ((line,) + seen[key])
+        elif not options.override and index_for( output_name ).lookup( key ):
+            print "Line %d: same diagram as %s" % (line, index_for( output_name ).lookup( key ))
+        elif output_name in names:
+            print "Line %d: %s is already being written" % (line, output_name)
+        elif not options.override and os.path.exists( output_name ):
+            print "Line %d: %s already exists" % (line, output_name)
+        else:
+            seen[key] = (line, output_name)
+            names.add( output_name )
+            # fen_to_image() may set black_to_move, so each job gets its own
+            todo.append( (line, key, fen, output_name, copy.copy( options )) )
+
+    # Load the art before forking, so the workers all share one copy
+    chessdiag.sprites()
+    pool = multiprocessing.Pool( options.processes, chessdiag.sprites )
+    saved = []                  # [(key, filename)] not yet in the index
+    count = 0
+    failed = 0
+    try:
+        for (line, key, output_name, error) in pool.imap_unordered( render_job, todo, 16 ):
+            if error:
+                print "Line %d: couldn't draw %s: %s" % (line, output_name, error)
+                failed += 1
+                continue
+            saved.append( (key, output_name) )
+            count += 1
+            if len( saved ) >= INDEX_BATCH:
+                add_to_indexes( saved )
+                saved = []
+    finally:
+        # Whatever was drawn stays drawn, even if the run was cut short
+        add_to_indexes( saved )
+    pool.close()
+    pool.join()
+    print "Saved %d diagrams" % count + (", %d failed" % failed if failed else "")
+
+# Record [(key, filename)] in the indexes of the files' directories
+def add_to_indexes( entries ):
+    by_index = {}
+    for (key, path) in entries:
+        by_index.setdefault( index_for( path ), [] ).append( (key, path) )
+    for (index, index_entries) in by_index.items():
+        index.add( index_entries )
+
+if __name__ == "__main__":
+    global_options = parser.parse_args()
+    if global_options.rebuild_index:
+        rebuild_index( global_options.rebuild_index )
+    elif global_options.batch:
+        draw_batch( global_options )
+    elif global_options.output_name:
+        draw_fen( pyperclip.paste(), global_options )
     else:
-        out_img.save (ref_filename )
+        parser.error( "an output name is needed unless rendering a batch" )
@@ -17,32 +17,39 @@
 # + Combine parse_results and parse_new_results
 # + Argument for initial year to graph
 # - Why does the graph end just before the right edge?
-# - Option to not read more data
-# - Stop reading new tnmt_results the instant we see an old xtbl?
-# - Use sets rather than lists to check for new results
+# + Option to not read more data
+# + Stop reading new tnmt_results the instant we see an old xtbl?
+# + Use sets rather than lists to check for new results
 # - Legend
-# - Window size as command-line parameter?
+# + Window size as command-line parameter?
 
 import argparse
+import cProfile
+import csv
 import pickle
 import datetime
-import math
-import matplotlib.pyplot as plt
+import elo
+import html
+import io
+import itertools
+import json
+import multiprocessing
 import numpy as np
 import os
+import profiling
 import re
-import requests
+import resultstore
 import sys
-from html.parser import HTMLParser
+import threading
+import time
+import uscfhttp
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from operator import attrgetter
 
-plt.style.use("seaborn")
-
-tournament_rating_re = re.compile( r"=>" )
 rating_re = re.compile( r"=>\s+(\d+)", re.MULTILINE )
 xtbl_re = re.compile( r"XtblMain.php\?([\d]+)" )
 tnmt_hst_re = re.compile( r"MbrDtlTnmtHst.php\?[\d]+\.[\d]+" )
-name_re = re.compile( "<b>\d+: ([^<]+)" )
+name_re = re.compile( r"<b>\d+: ([^<\n]+)" )
 
 # Map from web page result code to number of points
 result_to_value = { "L": 0.0, "S": 0.0,
@@ -52,124 +59,234 @@ result_to_value = { "L": 0.0, "S": 0.0,
 # The first year we don't need to look for results from
 NEXT_YEAR = datetime.datetime.now().year + 1
 
-# I'm rated d points above the other player; what's my EV?
-def rating_diff_to_expected_value( d ):
-    return 1.0 / (1.0 + pow( 10.0, -d / 400.0 ))
+# Where the USCF pages live; can be pointed elsewhere with --base_url
+USCF_BASE = "http://main.uschess.org"
+
+# uscfhttp.Fetcher that all page requests go through: set up from the
+# command-line options when run as a program, or by get_fetcher()
+fetcher = None
+fetcher_lock = threading.Lock()
+
+# The command-line options, when run as a program
+global_options = None
 
-# What's my total expected value if I have a given rating and will be
-# facing opponents with the given opponent ratings?
-def expected_value_total( rating, opp_ratings ):
-    return sum( rating_diff_to_expected_value( rating - r ) for r in opp_ratings )
+# matplotlib.pyplot, imported and set up the first time a graph is drawn:
+# importing it takes longer than everything else perf.py does in --tnmt
+# mode put together
+plt = None
 
-# Like expected_value_total() but with each game weighted by a value in
-# `weights`
-def expected_value_total_weighted( rating, opp_ratings, weights ):
-    return sum( weights[i] * rating_diff_to_expected_value( rating - r )
-                for (i,r) in enumerate( opp_ratings ) )
+def pyplot():
+    global plt
+    if plt is None:
+        import matplotlib.pyplot
+        matplotlib.pyplot.style.use( "seaborn" )
+        plt = matplotlib.pyplot
+    return plt
+
+# How long cached copies of each kind of page stay fresh, in seconds
+MEMBER_PAGE_TTL = 7 * 24 * 3600
+HISTORY_PAGE_TTL = 3600
+CURRENT_YEAR_TTL = 15 * 60
 
 # What rating would result in a total score of `score` against
 # opponents rated by `opp_ratings`, where the corresponding games are
 # weighted by `weights`?
+#
+# Solved by elo.perf_rating(), which takes Newton steps using the analytic
+# derivative and falls back to bisection if a step overshoots.
 def accurate_perf_rating_raw_weighted( opp_ratings, score, weights ):
-    if score == 0:
-        return min( opp_ratings ) - 400
-    elif score == len( opp_ratings ):
-        return max( opp_ratings ) + 400
-    
-    # Start by guessing our rating is the average of our opponents'
-    test_rating = sum( opp_ratings ) / len( opp_ratings )
-    iterations = 0
-    
-    # Use Newton's method
-    while iterations < 50:
-        eps = 1
-        test_score = expected_value_total_weighted( test_rating, opp_ratings, weights )
-        if abs( test_score - score ) < 0.001:
-            break
-        test_score_2 = expected_value_total_weighted( test_rating+eps, opp_ratings, weights )
-        slope = float( test_score_2 - test_score ) / eps
-        test_rating -= (test_score - score) / slope
-        iterations += 1
-        
-    return test_rating
+    return elo.perf_rating( opp_ratings, score, weights )
 
 # Same but each game is of equal weight
 def accurate_perf_rating_raw( opp_ratings, score ):
     return accurate_perf_rating_raw_weighted( opp_ratings, score, [1 for x in opp_ratings] )
 
+# accurate_perf_rating_raw() of many tournaments at once: [(opp_ratings,
+# score)] -> array of performance ratings. They're solved as one batch,
+# each tournament padded out to the length of the longest with weightless
+# games.
+def accurate_perf_ratings_raw( tournaments ):
+    width = max( len( opp_ratings ) for (opp_ratings, score) in tournaments )
+    opp = np.zeros( (len( tournaments ), width) )
+    weights = np.zeros( (len( tournaments ), width) )
+    for (i, (opp_ratings, score)) in enumerate( tournaments ):
+        opp[i, :len( opp_ratings )] = opp_ratings
+        weights[i, :len( opp_ratings )] = 1
+    scores = np.array( [ score for (opp_ratings, score) in tournaments ], dtype=float )
+    return elo.solve_perf_ratings( opp, weights, scores )[0]
+
 # What rating would I have to have so that the total number of points
-# scored in results is exactly what was expected?
+# scored in results is exactly what was expected? `results` is a history
+# array or a list of Results.
 def accurate_perf_rating( results ):
-    actual_total = sum( result_to_value[ r.result ] for r in results )
-    opp_ratings = [ r.opp_rating for r in results ]
-    return accurate_perf_rating_raw( opp_ratings, actual_total )
-
-# Same but the scores are to be weighted by `weights`
-def accurate_perf_rating_weighted( results, weights ):
-    actual_total = sum( weights[i] * result_to_value[ r.result ]
-                        for (i,r) in enumerate( results ) )
-    opp_ratings = [ r.opp_rating for r in results ]
-    return accurate_perf_rating_raw_weighted( opp_ratings, actual_total, weights )
+    history = as_history( results )
+    return accurate_perf_rating_raw( history["opp_rating"], history["score"].sum() )
 
 def xtbl_to_str( xtbl ):
     return "%s-%s-%s" % (xtbl[0:4], xtbl[4:6], xtbl[6:8] )
 
+# Date at the start of a crosstable ID as a yyyymmdd integer
+def xtbl_ymd( xtbl ):
+    return int( xtbl[0:8] )
+
 # A single tournament
 class TournamentResult():
+    __slots__ = ("xtbl", "rating", "ymd")
     def __init__( self, xtbl, rating ):
         self.xtbl = xtbl        # URL of the crosstable
         self.rating = rating    # Rating after the tournament
+        self.ymd = xtbl_ymd( xtbl ) # Date of the tournament as yyyymmdd
+    # Pickles from before __slots__ hold the attributes as a dict
+    def __setstate__( self, state ):
+        if isinstance( state, tuple ):
+            state = state[1]
+        self.__init__( state["xtbl"], state["rating"] )
     def __eq__( self, rhs ):
         return self.xtbl == rhs.xtbl
+    def __hash__( self ):
+        return hash( self.xtbl )
     def __repr__( self ):
         return "%s %d" % (self.xtbl, self.rating)
     def year( self ):
-        return int( self.xtbl[0:4] )
+        return self.ymd // 10000
 
 # A single game
 class Result():
+    __slots__ = ("opp_rating", "result", "xtbl", "rd", "score", "ymd")
     def __init__( self, opp_rating, result, xtbl, rd ):
         self.opp_rating = opp_rating # Opponent rating
         self.result = result         # Code for result (see result_to_value)
         self.xtbl = xtbl             # URL of crosstable
         self.rd = rd                 # Round number
+        self.score = result_to_value[ result ] # Points scored
+        self.ymd = xtbl_ymd( xtbl )  # Date of the tournament as yyyymmdd
+    # Pickles from before __slots__ hold the attributes as a dict
+    def __setstate__( self, state ):
+        if isinstance( state, tuple ):
+            state = state[1]
+        self.__init__( state["opp_rating"], state["result"], state["xtbl"], state["rd"] )
     def __eq__( self, rhs ):
         return self.xtbl == rhs.xtbl and self.rd == rhs.rd
+    def __hash__( self ):
+        return hash( (self.xtbl, self.rd) )
     def __repr__( self ):
         return "%d %s (%s:%d)" % (self.opp_rating, self.result, self.xtbl, self.rd)
     # Naive "performance rating" for this single game
     def val( self ):
-        return self.opp_rating + (result_to_value[ self.result ] - 0.5) * 800
+        return self.opp_rating + (self.score - 0.5) * 800
     def year( self ):
-        return int( self.xtbl[0:4] )
-
-# Returns the value associated with `key` in a list of (key, value) tuples,
-# or None
-def alist_find( alist, key ):
-    for (k,v) in alist:
-        if k == key: return v
-    return None
+        return self.ymd // 10000
+
+# [Result] -> history array (see resultstore.HISTORY_DTYPE)
+def results_to_history( results ):
+    return resultstore.history_from_columns( [ r.opp_rating for r in results ],
+                                             [ r.score for r in results ],
+                                             [ int( r.xtbl ) for r in results ],
+                                             [ r.rd for r in results ],
+                                             [ r.ymd for r in results ] )
+
+# History array or [Result] -> history array
+def as_history( results ):
+    if isinstance( results, np.ndarray ):
+        return results
+    return results_to_history( results )
+
+# Kinds of token produced by html_tokens()
+START_TAG, END_TAG, DATA = range( 3 )
+
+# One token of a page: a run of text; a comment, a whole <script> or
+# <style> element, a declaration or processing instruction, all of which
+# are skipped; a start or end tag (with any attributes); or a "<" that
+# doesn't start any of those
+token_re = re.compile( r"""([^<]+)
+                         | <!--.*?-->
+                         | <(script|style)\b.*?</\2\s*>
+                         | <!(?!--)[^>]*> | <\?[^>]*>
+                         | <(/?)([a-zA-Z][^\t\n\r\f />\x00]*)((?:"[^"]*"|'[^']*'|[^'">])*)>
+                         | <""",
+                       re.DOTALL | re.IGNORECASE | re.VERBOSE )
+# Markup that might be complete once more of the page arrives
+partial_markup_re = re.compile( r"<(?:!--(?!.*?-->)|(script|style)\b(?!.*?</\1)|[^>]*$)",
+                                re.DOTALL | re.IGNORECASE )
+href_re = re.compile( r"""\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.IGNORECASE )
+
+# Page text in chunks of any size -> iterator of (START_TAG, tag, attribute
+# text), (END_TAG, tag, None) and (DATA, text, None), like the callbacks of
+# html.parser.HTMLParser with convert_charrefs set. Tag names are lower
+# case; comments, declarations and <script> and <style> elements are
+# skipped. Tokens are produced as soon as they're complete, so a page can
+# be parsed while it's still downloading.
+def html_tokens( chunks ):
+    pending = ""                # Unconsumed text from the last chunk
+    data = []                   # Pieces of the current run of text
+    for chunk in itertools.chain( chunks, [None] ):
+        final = chunk is None
+        text = pending + chunk if not final else pending
+        pending = ""
+        for m in token_re.finditer( text ):
+            (run, _, slash, tag, attrs) = m.groups()
+            if run is not None:
+                data.append( run )
+                continue
+            if m.end() - m.start() == 1:
+                if not final and partial_markup_re.match( text, m.start() ):
+                    pending = text[m.start():]
+                    break
+                data.append( "<" )  # Not markup after all
+                continue
+            if data:
+                yield (DATA, unescape_data( "".join( data ) ), None)
+                data = []
+            if tag is None:
+                continue
+            tag = tag.lower()
+            if not final and not slash and (tag == "script" or tag == "style"):
+                pending = text[m.start():]  # Wait for the end of the element
+                break
+            if slash:
+                yield (END_TAG, tag, None)
+            else:
+                yield (START_TAG, tag, attrs)
+                if attrs.endswith( "/" ):
+                    yield (END_TAG, tag, None)
+    if data:
+        yield (DATA, unescape_data( "".join( data ) ), None)
+
+def unescape_data( text ):
+    return html.unescape( text ) if "&" in text else text
+
+# Attribute text of a start tag -> value of its href attribute, or ""
+def find_href( attrs ):
+    m = href_re.search( attrs )
+    if m is None:
+        return ""
+    return html.unescape( next( g for g in m.groups() if g is not None ) )
 
 # Base class to automatically keep track of some stuff
-class TableParser( HTMLParser ):
+class TableParser():
     def __init__( self ):
-        HTMLParser.__init__( self )
         self.tag_stack = []     # What tags are we nested in
         self.cur_col = 0        # Column of current table
         self.in_td = 0          # Are we in a <td> tag
 
-    def handle_starttag( self, tag, attrs ):
-        self.tag_stack.append( tag )
-        if tag == "tr":
-            self.cur_col = -1
-        if tag == "td":
-            self.cur_col += 1
-            self.in_td += 1
-
-    def handle_endtag( self, tag ):
-        self.tag_stack = self.tag_stack[:-1]
-        if tag == "td":
-            self.in_td -= 1
+    # Page text in chunks -> iterator of html_tokens(), keeping track of
+    # where in the table we are as it goes
+    def tokens( self, chunks ):
+        for token in html_tokens( chunks ):
+            (kind, value, attrs) = token
+            if kind == START_TAG:
+                self.tag_stack.append( value )
+                if value == "tr":
+                    self.cur_col = -1
+                elif value == "td":
+                    self.cur_col += 1
+                    self.in_td += 1
+            elif kind == END_TAG:
+                if self.tag_stack:
+                    self.tag_stack.pop()
+                if value == "td":
+                    self.in_td -= 1
+            yield token
 
     def cur_tag( self ):
         if len( self.tag_stack ) == 0:
@@ -177,113 +294,125 @@ class TableParser( HTMLParser ):
         else:
             return self.tag_stack[-1]
 
-# Reads a page of tournament results and stuffs the results into self.results
+# Reads a page of tournament results
 class TournamentResultsParser( TableParser ):
     def __init__( self ):
         TableParser.__init__( self )
-        self.xtbl = None        # URL of current crosstable
-        self.rating = 0         # Rating after current tournament
-        self.results = []       # [TournamentResult]
         self.any_results = False # True if any tournaments, even blitz
 
-    def handle_starttag( self, tag, attrs ):
-        TableParser.handle_starttag( self, tag, attrs )
-        if tag == "a":
-            if self.cur_col == 1:
-                xtbl_link = alist_find( attrs, "href" )
-                m = xtbl_re.search( xtbl_link )
-                if m:
-                    self.xtbl = m.group( 1 )
-                    self.any_results = True
-
-    def handle_endtag( self, tag ):
-        TableParser.handle_endtag( self, tag )
-        if tag == "tr" and self.xtbl and self.rating != 0:
-            self.results.append( TournamentResult( self.xtbl, self.rating ) )
-            self.xtbl = None
-            self.rating = 0
-
-    def handle_data( self, data ):
-        if self.in_td > 0:
-            if self.cur_col == 2 and self.cur_tag() == "b" and self.xtbl:
-                m = re.match( "\d+", data )
-                self.rating = int( m.group( 0 ) )
-
-# Reads a page of results for a given year and stuffs the results into self.results
+    # Page text in chunks -> iterator of TournamentResult
+    def parse( self, chunks ):
+        xtbl = None             # URL of current crosstable
+        rating = 0              # Rating after current tournament
+        for (kind, value, attrs) in self.tokens( chunks ):
+            if kind == DATA:
+                if self.in_td > 0 and self.cur_col == 2 and xtbl and self.cur_tag() == "b":
+                    m = re.match( r"\d+", value )
+                    rating = int( m.group( 0 ) )
+            elif kind == START_TAG:
+                if value == "a" and self.cur_col == 1:
+                    m = xtbl_re.search( find_href( attrs ) )
+                    if m:
+                        xtbl = m.group( 1 )
+                        self.any_results = True
+            elif value == "tr" and xtbl and rating != 0:
+                yield TournamentResult( xtbl, rating )
+                xtbl = None
+                rating = 0
+
+# Reads a page of results for a given year
 class YearResultsParser( TableParser ):
-    def __init__( self ):
-        TableParser.__init__( self )
-        self.rating = 0           # Rating for this game
-        self.results = []         # [Result]
-        self.reading_data = False # Have we gotten to the actual data
-        self.xtbl = None          # URL of crosstable
-        self.rd = 0               # Round of this game
-        self.result = None        # code for game result
-
-    def handle_starttag( self, tag, attrs ):
-        TableParser.handle_starttag( self, tag, attrs )
-        if tag == "a":
-            if self.cur_col == 0:
-                xtbl_link = alist_find( attrs, "href" )
-                m = xtbl_re.search( xtbl_link )
-                if m:
-                    self.xtbl = m.group( 1 )
-
-    def handle_endtag( self, tag ):
-        TableParser.handle_endtag( self, tag )
-        if tag == "tr" and self.result:
-            self.results.append( Result( self.rating, self.result, self.xtbl, self.rd ) )
-            self.xtbl = None
-            self.rd = 0
-            self.rating = 0
-            self.result = None
-
-    def handle_data( self, data ):
-        if not self.reading_data and self.cur_tag() == "th" and data == "Event Name":
-            self.reading_data = True
-
-        if self.reading_data:
-            if self.in_td > 0:
-                if self.cur_col == 2:
-                    self.rd = int( data )
-                elif self.cur_col == 6:
-                    m = rating_re.search( data )
+    # Page text in chunks -> iterator of Result
+    def parse( self, chunks ):
+        rating = 0              # Rating for this game
+        reading_data = False    # Have we gotten to the actual data
+        xtbl = None             # URL of crosstable
+        rd = 0                  # Round of this game
+        result = None           # code for game result
+        for (kind, value, attrs) in self.tokens( chunks ):
+            if kind == DATA:
+                if not reading_data:
+                    reading_data = value == "Event Name" and self.cur_tag() == "th"
+                if reading_data and self.in_td > 0:
+                    if self.cur_col == 2:
+                        rd = int( value )
+                    elif self.cur_col == 6:
+                        m = rating_re.search( value )
+                        if m:
+                            rating = int( m.group( 1 ) )
+                    elif self.cur_col == 7:
+                        result = value[0]
+            elif kind == START_TAG:
+                if value == "a" and self.cur_col == 0:
+                    m = xtbl_re.search( find_href( attrs ) )
                     if m:
-                        self.rating = int( m.group( 1 ) )
-                elif self.cur_col == 7:
-                    self.result = data[0]
+                        xtbl = m.group( 1 )
+            elif value == "tr" and result:
+                yield Result( rating, result, xtbl, rd )
+                xtbl = None
+                rd = 0
+                rating = 0
+                result = None
 
 # Return the URL providing the stats for the player with USCF ID `id`
 # in the given year
 def year_stats_page_url( id, year ):
-    return "http://main.uschess.org/datapage/gamestats.php?memid=%s&ptype=Y&rs=R&dkey=%d&drill=Y" % (id, year )
+    return USCF_BASE + "/datapage/gamestats.php?memid=%s&ptype=Y&rs=R&dkey=%d&drill=Y" % (id, year )
 
 # Return the URL corresponding to the player with USCF ID `id`
 def tournament_stats_page_url( id ):
-    return "http://main.uschess.org/assets/msa_joomla/MbrDtlTnmtHst.php?%s" % id
+    return USCF_BASE + "/assets/msa_joomla/MbrDtlTnmtHst.php?%s" % id
+
+# How long after the end of a year games from it may still be rated (USCF
+# often rates late-December events in January)
+YEAR_SETTLE_TIME = 60 * 24 * 3600
+
+# How long a cached copy of the game list for `year` stays fresh. Once a
+# year is over and its last events have been rated, its games can't
+# change, so a copy fetched after then never needs fetching again: the TTL
+# is the time since then. Until then, it's the current year's TTL.
+def year_stats_ttl( year ):
+    settled = datetime.datetime( year + 1, 1, 1 ).timestamp() + YEAR_SETTLE_TIME
+    return max( CURRENT_YEAR_TTL, time.time() - settled )
+
+# The Fetcher to use. When perf is used as a library and nothing has set
+# one, that's a Fetcher with the default settings and no disk cache.
+def get_fetcher():
+    global fetcher
+    with fetcher_lock:
+        if fetcher is None:
+            fetcher = uscfhttp.Fetcher()
+        return fetcher
+
+# fetcher.stream() of a page, with the time spent waiting for it profiled
+# as "fetch" apart from the time spent parsing it
+def page_chunks( url, ttl ):
+    profiling.count( "pages" )
+    return profiling.metered( get_fetcher().stream( url, ttl ), "fetch" )
+
+# Likewise for fetcher.get()
+def get_page( url, ttl ):
+    return "".join( page_chunks( url, ttl ) )
 
 # id -> year -> [Result]
+@profiling.timed( "year_stats" )
 def year_stats( id, year ):
-    r = requests.get( year_stats_page_url( id, year ) )
-    parser = YearResultsParser()
-    parser.feed( r.text )
-    return parser.results
+    url = year_stats_page_url( id, year )
+    return list( YearResultsParser().parse( page_chunks( url, year_stats_ttl( year ) ) ) )
 
 def name_from_id( id ):
-    url = "http://main.uschess.org/assets/msa_joomla/MbrDtlMain.php?%s" % id
-    r = requests.get( url )
-    for l in r.text.split("\n"):
-        m = name_re.search( l )
-        if m:
-            return m.group( 1 ).replace( "&nbsp;", " " )
+    url = USCF_BASE + "/assets/msa_joomla/MbrDtlMain.php?%s" % id
+    m = name_re.search( get_page( url, MEMBER_PAGE_TTL ) )
+    if m:
+        return m.group( 1 ).replace( "&nbsp;", " " )
     return ""
 
 # Display one year's stats textually
-def parse_year_stats( id, year ):
-    results = year_stats( id, year )
+def parse_year_stats( year, results ):
     if len( results ) > 0:
-        naive_perf = sum( r.val() for r in results ) / len( results )
-        accurate_perf = accurate_perf_rating( results )
+        history = results_to_history( results )
+        naive_perf = (history["opp_rating"] + (history["score"] - 0.5) * 800).mean()
+        accurate_perf = accurate_perf_rating( history )
         print( "%d: %4d %4d (%3d games)" % (year,
                                             round( naive_perf ),
                                             round( accurate_perf ),
@@ -292,139 +421,214 @@ def parse_year_stats( id, year ):
 # Display all years' stats textually
 def run_by_year( id ):
     print( "Year  Fast  Acc %s" % (name_from_id( id )) )
-    for y in range( 1994, NEXT_YEAR ):
-        parse_year_stats( id, y )
+    years = range( 1994, NEXT_YEAR )
+    for (y, results) in zip( years, get_fetcher().map( lambda y: year_stats( id, y ), years ) ):
+        parse_year_stats( y, results )
 
-# Return a list of (i, x) pairs, where i = last game # with crosstable x
+# Return a list of (i, x) pairs, where i = last game # with crosstable x,
+# sorted by i
 def xtbl_indices( xtbls ):
-    mapping = {}
-    for (i, x) in enumerate( xtbls ):
-        mapping[x] = i          # overwrite earlier indices with later ones
-    vals = []
-    for (k, v) in mapping.items():
-        vals.append( (v, k) )
-    return sorted( vals )
-
-# Filename of pickle file corresponding to `id`
+    xtbls = np.asarray( xtbls )
+    # The first occurrence in the reversed array is the last one
+    (uniques, first_from_end) = np.unique( xtbls[::-1], return_index=True )
+    last = len( xtbls ) - 1 - first_from_end
+    order = np.argsort( last )
+    return list( zip( last[order].tolist(), uniques[order].tolist() ) )
+
+# Filename of the pickle file corresponding to `id`, where results were
+# kept before there was a ResultStore
 def pickle_file( id ):
     return "pickle/%s.pickle" % id
 
-# Id -> [TournamentResult]
-def get_tournament_history( id, tnmt_results ):
+# Page text in chunks -> ([TournamentResult], any tournaments at all?)
+def parse_tournament_text( chunks ):
+    parser = TournamentResultsParser()
+    results = list( parser.parse( chunks ) )
+    return (results, parser.any_results)
+
+# URL -> ([TournamentResult], any tournaments at all?)
+def parse_tournament_page( url ):
+    return parse_tournament_text( page_chunks( url, HISTORY_PAGE_TTL ) )
+
+# Id -> [TournamentResult] -> [TournamentResult]
+#
+# Adds any tournaments not already in `tnmt_results`. The history lists
+# tournaments newest first, so in incremental mode, once we know some of
+# the player's tournaments, we read the pages one at a time (starting with
+# the summary page we already have) and stop after the first one that
+# mentions a tournament we knew about: everything beyond it is older.
+# Otherwise all the pages are fetched at once. The summary page lists the
+# same tournaments as the first page of the history (<id>.1), so that one
+# is never fetched.
+@profiling.timed( "tournament_history" )
+def get_tournament_history( id, tnmt_results, incremental=True ):
     u = tournament_stats_page_url( id )
-    tnmt_r = requests.get( u )
+    first_page = get_page( u, HISTORY_PAGE_TTL )
     tnmt_pages = []             # URLs of pages listing tournaments
-    for l in tnmt_r.text.split("\n"):
-        m = tnmt_hst_re.search( l )
-        if m:
-            tnmt_pages.append( "http://main.uschess.org/assets/msa_joomla/" + m.group( 0 ) )
-    if len( tnmt_pages ) == 0:
-        tnmt_pages.append( u )  # All tournaments were on the first page
-    for page in tnmt_pages:
-        r = requests.get( page )
-        parser = TournamentResultsParser()
-        parser.feed( r.text )
-        saw_new_result = False
-        for new_result in parser.results:
+    for m in tnmt_hst_re.finditer( first_page ):
+        page = USCF_BASE + "/assets/msa_joomla/" + m.group( 0 )
+        if page not in tnmt_pages:
+            tnmt_pages.append( page )
+    tnmt_pages = [ page for page in tnmt_pages if page not in (u, u + ".1") ]
+
+    known_before = set( tnmt_results )
+    known = set( tnmt_results )
+    incremental = incremental and len( known_before ) > 0
+    if incremental:
+        rest = map( parse_tournament_page, tnmt_pages )
+    else:
+        rest = get_fetcher().map( parse_tournament_page, tnmt_pages )
+    pages = itertools.chain( [ parse_tournament_text( [ first_page ] ) ], rest )
+    pages_read = 0
+    for (page_results, any_results) in pages:
+        pages_read += 1
+        reached_known = False
+        for new_result in page_results:
+            if new_result in known_before:
+                reached_known = True
             # It's possible to see a tournament twice if it was dual-rated
-            if new_result not in tnmt_results:
-                saw_new_result = True
+            elif new_result not in known:
+                known.add( new_result )
                 tnmt_results.append( new_result )
-        if not parser.any_results:
+        if not any_results or (incremental and reached_known):
             break
+    if incremental:
+        fetched = pages_read - 1  # We already had the summary page
+        print( "Reached known tournaments after fetching %d of %d history pages; "
+               "skipped %d requests." % (fetched, len( tnmt_pages ), len( tnmt_pages ) - fetched) )
     return tnmt_results
     
 # id -> [Result] -> [TournamentResult] -> ([Result], [TournamentResult])
 #
 # `results` and `tnmt_results` are the individual game results and
 # tournament results we already know about. Grab whatever data we don't
-# have yet and return the updated lists.
-def parse_results( id, results, tnmt_results ):
+# have yet and return the updated lists. See get_tournament_history() for
+# `incremental`.
+def parse_results( id, results, tnmt_results, incremental=True ):
     # We should never have to look at an earlier year than we already have
     # some data for
     max_saved_year = max( r.year() for r in results ) if results else 1994
     print( "Getting new yearly stats starting from %s..." % max_saved_year )
-    new_results = []
-    for y in range( max_saved_year, NEXT_YEAR ):
-        for new_result in year_stats( id, y ):
-            if new_result not in results:
+    known = set( results )
+    years = range( max_saved_year, NEXT_YEAR )
+    for year_results in get_fetcher().map( lambda y: year_stats( id, y ), years ):
+        for new_result in year_results:
+            if new_result not in known:
+                known.add( new_result )
                 results.append( new_result )
     results.sort( key=attrgetter( "xtbl", "rd" ) )
     print( "Getting new tournament history..." )
-    tnmt_results = get_tournament_history( id, tnmt_results )
+    tnmt_results = get_tournament_history( id, tnmt_results, incremental )
     return (results, tnmt_results)
 
-# id -> ([Result], [TournamentResult])
-def read_results( id ):
-    results = []
-    tnmt_results = []
+# Filename of the results store corresponding to `id`
+def store_file( id ):
+    return "store/%s.sqlite" % id
+
+# Row for ResultStore.add_results() corresponding to a Result
+def result_row( r ):
+    return (r.xtbl, r.rd, r.opp_rating, r.result, result_to_value[ r.result ])
+
+# Reads the old pickle files, which were written with perf.py running as
+# __main__ and so refer to __main__.Result and __main__.TournamentResult
+class ResultUnpickler( pickle.Unpickler ):
+    def find_class( self, module, name ):
+        if module == "__main__":
+            module = __name__
+        return pickle.Unpickler.find_class( self, module, name )
+
+# id -> ResultStore. The first time, copies in whatever was in the
+# player's old pickle file.
+@profiling.timed( "store" )
+def open_store( id ):
+    store = resultstore.ResultStore( store_file( id ) )
+    pf = pickle_file( id )
+    if store.is_empty() and os.path.exists( pf ):
+        with open( pf, "rb" ) as f:
+            # The two lists were pickled separately, so each needs its own
+            # unpickler
+            results = ResultUnpickler( f ).load()
+            tnmt_results = ResultUnpickler( f ).load()
+        store.add_tournament_results( [ (r.xtbl, r.rating) for r in tnmt_results ] )
+        store.add_results( [ result_row( r ) for r in results ] )
+        print( "Moved %d games from %s to %s" % (len( results ), pf, store_file( id )) )
+    return store
 
-    # Read pickled data if present
-    try:
-        pf = pickle_file( id )
-        f = open( pf, "rb" )
-        results = pickle.load( f )
-        tnmt_results = pickle.load( f )
-        f.close()
-    except IOError:
-        pass
-
-    (results, tnmt_results) = parse_results( id, results, tnmt_results )
-
-    f = open( pf, "wb" )
-    pickle.dump( results, f )
-    pickle.dump( tnmt_results, f )
-    f.close()
+# id -> ([Result], [TournamentResult])
+@profiling.timed( "read_results" )
+def read_results( id, incremental=True ):
+    store = open_store( id )
+    with profiling.phase( "store" ):
+        results = [ Result( *row ) for row in store.results() ]
+        tnmt_results = [ TournamentResult( *row ) for row in store.tournament_results() ]
+    stored = set( results )
+    stored_tnmts = set( tnmt_results )
+
+    (results, tnmt_results) = parse_results( id, results, tnmt_results, incremental )
+
+    with profiling.phase( "store" ):
+        store.add_results( [ result_row( r ) for r in results if r not in stored ] )
+        store.add_tournament_results( [ (r.xtbl, r.rating) for r in tnmt_results
+                                        if r not in stored_tnmts ] )
+        store.close()
     return (results, tnmt_results)
 
-def year_change_indices( results ):
-    cur_year = 0
-    ans = []
-    for (i, result) in enumerate( results ):
-        y = result.year()
-        if (y != cur_year):
-            ans.append( (i, y) )
-        cur_year = y
+# id -> history array of the player's stored games
+def history_array( id ):
+    store = open_store( id )
+    with profiling.phase( "store" ):
+        ans = store.history()
+        store.close()
     return ans
 
-PI = 3.14159265
-
-def normal_distribution( std_dev, length, center ):
-    return [ math.exp( - float(i - center)**2 / (2*std_dev**2))
-             for i in range( length ) ]
-
-def run_by_window( id ):
-    window_size = 60            # how many games to look at at once
-
-    (results, tnmt_results) = read_results( id )
-    tnmt_map = { r.xtbl: r.rating for r in tnmt_results } # xtbl -> rating
-
-    ratings = []                # recent perf rating after each game
-    xtbls = []                  # crosstable id of each game
-    if len( results ) < window_size:
-        print( "Not enough games yet." )
-        return
-
-    print( "Generating graph..." )
-    for x in range( 0, len( results ) + 1):
-        begin = max( 0, x - window_size )
-        end = min( len( results ), x + window_size )
-        distr = normal_distribution( 20, end - begin, x - begin )
-        ratings.append( accurate_perf_rating_weighted( results[begin:end], distr ) )
-        xtbls.append( results[x-1].xtbl )
+# History array -> [(i, y)] where game i is the first one in year y
+def year_change_indices( history ):
+    years = history["year"]
+    starts = np.flatnonzero( np.diff( years, prepend=0 ) )
+    return list( zip( starts.tolist(), years[starts].tolist() ) )
+
+WINDOW_SIZE = 60                # how many games either side to look at, by default
+
+# id -> (name, history array, [TournamentResult])
+def load_player( id, incremental=True ):
+    (results, tnmt_results) = read_results( id, incremental )
+    return (name_from_id( id ), history_array( id ), tnmt_results)
+
+# History array -> recent perf rating after each game, over the games
+# within `window_size` games of it or, if `window_days` is given, within
+# that many days
+@profiling.timed( "solve" )
+def rating_curve( history, window_size=WINDOW_SIZE, window_days=None ):
+    if window_days:
+        return list( elo.date_window_perf_ratings( history["opp_rating"], history["score"],
+                                                   history["date"], window_days ) )
+    return list( elo.window_perf_ratings( history["opp_rating"], history["score"],
+                                          window_size, window_size / 3 ) )
+
+# Are there enough games in a history to draw its rating_curve()?
+def enough_games( history, window_size, window_days ):
+    return len( history ) >= (1 if window_days else window_size)
+
+# Draw the performance and rating graph for one player, starting from
+# `initial_year`, and save it as a PDF. Returns the PDF's filename.
+@profiling.timed( "render" )
+def render_graph( id, name, history, tnmt_results, ratings, initial_year ):
+    tnmt_map = { int( r.xtbl ): r.rating for r in tnmt_results } # xtbl -> rating
+    # Crosstable id of each game, as for results[x-1].xtbl
+    xtbls = np.concatenate( (history["xtbl"][-1:], history["xtbl"]) )
     (tnmt_indices, tnmt_xtbls) = zip( *xtbl_indices( xtbls ) )
     tnmt_ratings = [tnmt_map[x] for x in tnmt_xtbls]
-    name = name_from_id( id )
 
     # Chop off results before the initial year
-    initial_year = global_options.year or 0
-    active_results = results
-    first_idx = next( i for i,v in enumerate( active_results ) if v.year() >= initial_year )
+    active_results = history
+    first_idx = int( np.argmax( active_results["year"] >= initial_year ) )
     ratings = ratings[first_idx:]
     active_results = active_results[first_idx:]
     tnmt_indices = [i - first_idx for i in tnmt_indices if i >= first_idx]
     tnmt_ratings = tnmt_ratings[len(tnmt_ratings) - len(tnmt_indices):]
 
+    plt = pyplot()
+    plt.figure()
     plt.plot( tnmt_indices, tnmt_ratings, color="#b0b0b0" )
     plt.plot( range( len( ratings ) ), ratings )
     plt.title( name + "\n" )
@@ -433,27 +637,302 @@ def run_by_window( id ):
     (indices, years) = zip( *year_changes )
     plt.xticks( indices, years, rotation = 'vertical', size = 'small' )
     out_name = "out/%s %s.pdf" % (id, name)
-    plt.savefig( out_name )
+    with profiling.phase( "savefig" ):
+        plt.savefig( out_name )
+    plt.close()
+    return out_name
+
+# Graph one player's rating history. See rating_curve() for `window_size`
+# and `window_days`, and get_tournament_history() for `incremental`.
+def run_by_window( id, initial_year=0, incremental=True, window_size=WINDOW_SIZE, window_days=None,
+                   open_graph=False ):
+    (name, history, tnmt_results) = load_player( id, incremental )
+    if not enough_games( history, window_size, window_days ):
+        print( "Not enough games yet." )
+        return
 
-    if global_options.open:
+    print( "Generating graph..." )
+    ratings = rating_curve( history, window_size, window_days )
+    out_name = render_graph( id, name, history, tnmt_results, ratings, initial_year )
+
+    if open_graph:
         os.system( 'open "%s"' % out_name )
 
     print( "Done." )
 
-def run():
-    run_by_window( sys.argv[1] )
-
-parser = argparse.ArgumentParser( description="Analyze USCF tournament performance results." )
-parser.add_argument( "-i", "--id", help="USCF ID" )
-parser.add_argument( "-y", "--year", help="Initial year", type=int )
-parser.add_argument( "-t", "--tnmt", help="Tournament results", nargs="*" )
-parser.add_argument( "-o", "--open", help="Open graph after computation", action="store_true" )
-global_options = parser.parse_args()
-
-if global_options.id:
-    run_by_window( global_options.id )
-elif global_options.tnmt:
-    ratings = global_options.tnmt[:-1]
-    score = global_options.tnmt[-1]
-    print( int( round( accurate_perf_rating_raw( [int( r ) for r in ratings],
-                                                 float( score ) ) ) ) )
+# Each argument is either a USCF ID or the name of a file listing IDs, one
+# per line (blank lines and anything after a # are ignored). Returns the
+# IDs in order with duplicates removed.
+def batch_ids( args ):
+    ids = []
+    for arg in args:
+        if os.path.isfile( arg ):
+            with open( arg ) as f:
+                for l in f:
+                    id = l.split( "#" )[0].strip()
+                    if id:
+                        ids.append( id )
+        else:
+            ids.append( arg )
+    return list( dict.fromkeys( ids ) )
+
+# Calls fn(*args) and returns (seconds taken, result)
+def timed_call( fn, *args ):
+    start = time.perf_counter()
+    ans = fn( *args )
+    return (time.perf_counter() - start, ans)
+
+# Graph many players at once, as a pipeline: players' pages are fetched
+# on `workers` threads, and as each player's data arrives its rating curve
+# and then its graph are computed in a pool of `processes` processes.
+# Prints how long each stage took for each player. See rating_curve() for
+# `window_size` and `window_days`.
+def run_batch( ids, initial_year, workers, processes, incremental=True,
+               window_size=WINDOW_SIZE, window_days=None ):
+    start = time.perf_counter()
+    players = {}                # id -> load_player( id )
+    stage_times = { id: {} for id in ids } # id -> stage -> seconds
+    outcomes = {}               # id -> output filename or error
+    # Spawn rather than fork, since the fetching threads are already running
+    with ThreadPoolExecutor( max_workers=workers ) as loaders, \
+         ProcessPoolExecutor( processes, mp_context=multiprocessing.get_context( "spawn" ) ) as pool:
+        # Work for the process pool. When profiling, the workers profile it
+        # too and send what they recorded back with the result.
+        def submit( fn, *args ):
+            if profiling.enabled:
+                return pool.submit( profiling.collect, timed_call, fn, *args )
+            return pool.submit( timed_call, fn, *args )
+
+        pending = { loaders.submit( timed_call, load_player, id, incremental ): (id, "fetch")
+                    for id in ids }
+        while pending:
+            (done, _) = wait( pending, return_when=FIRST_COMPLETED )
+            for future in done:
+                (id, stage) = pending.pop( future )
+                try:
+                    ans = future.result()
+                except Exception as e:
+                    outcomes[id] = "%s failed: %s" % (stage, e)
+                    continue
+                if profiling.enabled and stage != "fetch":
+                    (ans, profile) = ans
+                    profiling.merge( profile )
+                (seconds, value) = ans
+                stage_times[id][stage] = seconds
+                if stage == "fetch":
+                    players[id] = value
+                    (name, history, tnmt_results) = value
+                    if not enough_games( history, window_size, window_days ):
+                        outcomes[id] = "Not enough games yet."
+                    else:
+                        pending[submit( rating_curve, history, window_size,
+                                        window_days )] = (id, "solve")
+                elif stage == "solve":
+                    (name, history, tnmt_results) = players[id]
+                    pending[submit( render_graph, id, name, history, tnmt_results,
+                                    value, initial_year )] = (id, "render")
+                else:
+                    outcomes[id] = value
+
+    print( "%-10s %6s %7s %7s %7s  %s" % ("ID", "Games", "Fetch", "Solve", "Render", "Result") )
+    for id in ids:
+        times = stage_times[id]
+        games = len( players[id][1] ) if id in players else 0
+        print( "%-10s %6d %7s %7s %7s  %s" %
+               (id, games,
+                *[ "%.2f" % times[stage] if stage in times else "-"
+                   for stage in ("fetch", "solve", "render") ],
+                outcomes.get( id, "" )) )
+    print( "%d players in %.2f s" % (len( ids ), time.perf_counter() - start) )
+    return outcomes
+
+# Do whatever the command line asked for
+def run_command():
+    if global_options.batch:
+        outcomes = run_batch( batch_ids( global_options.batch ), global_options.year or 0,
+                              global_options.workers, global_options.processes,
+                              not global_options.full, global_options.window,
+                              global_options.window_days )
+        if global_options.open:
+            for out_name in outcomes.values():
+                if out_name.endswith( ".pdf" ):
+                    os.system( 'open "%s"' % out_name )
+    elif global_options.id:
+        try:
+            run_by_window( global_options.id, global_options.year or 0, not global_options.full,
+                           global_options.window, global_options.window_days, global_options.open )
+        except uscfhttp.CacheMiss as e:
+            print( "Not in the page cache: %s" % e )
+            sys.exit( 1 )
+    elif global_options.tnmt:
+        ratings = global_options.tnmt[:-1]
+        score = global_options.tnmt[-1]
+        print( int( round( accurate_perf_rating_raw( [int( r ) for r in ratings],
+                                                     float( score ) ) ) ) )
+    elif global_options.tnmt_file:
+        try:
+            if global_options.tnmt_file == "-":
+                run_bulk( sys.stdin, sys.stdout )
+            else:
+                with open( global_options.tnmt_file ) as f:
+                    run_bulk( f, sys.stdout )
+        except BadTournament as e:
+            print( "Bad tournament in %s, %s" % (global_options.tnmt_file, e), file=sys.stderr )
+            sys.exit( 1 )
+
+# Tournaments read and solved at once in --tnmt_file mode
+BULK_BATCH = 4096
+
+class BadTournament( Exception ):
+    pass
+
+def csv_line( fields ):
+    out = io.StringIO()
+    csv.writer( out, lineterminator="" ).writerow( fields )
+    return out.getvalue()
+
+# A line of a --tnmt_file file -> (opponent ratings, score, fn(rating) ->
+# line to write for it), or None if it's blank or a comment. A line is
+# either a JSON object with "opp_ratings" and "score", written back with
+# "perf_rating" added, or comma-separated opponent ratings and then the
+# score, as --tnmt takes them, optionally after a name that's written
+# back before the rating.
+def parse_tournament_line( l ):
+    l = l.strip()
+    if not l or l.startswith( "#" ):
+        return None
+    if l.startswith( "{" ):
+        record = json.loads( l )
+        opp_ratings = [ float( r ) for r in record["opp_ratings"] ]
+        score = float( record["score"] )
+        answer = lambda rating: json.dumps( dict( record, perf_rating=rating ) )
+    else:
+        fields = [ field.strip() for field in next( csv.reader( [ l ] ) ) ]
+        name = None
+        try:
+            float( fields[0] )
+        except ValueError:
+            name = fields.pop( 0 )
+        if len( fields ) < 2:
+            raise ValueError( "expected opponent ratings and a score" )
+        opp_ratings = [ float( r ) for r in fields[:-1] ]
+        score = float( fields[-1] )
+        if name is None:
+            answer = str
+        else:
+            answer = lambda rating: csv_line( [ name, rating ] )
+    if not opp_ratings:
+        raise ValueError( "no opponent ratings" )
+    if not np.isfinite( opp_ratings + [ score ] ).all():
+        raise ValueError( "ratings and score must be finite numbers" )
+    if score < 0 or score > len( opp_ratings ):
+        raise ValueError( "score of %g from %d games" % (score, len( opp_ratings )) )
+    return (opp_ratings, score, answer)
+
+# --tnmt_file: the performance rating of each tournament in `f` (see
+# parse_tournament_line()), written to `out` in order. Tournaments are
+# solved BULK_BATCH at a time, and each batch's answers written as soon as
+# it's done.
+def run_bulk( f, out ):
+    batch = []
+    def flush():
+        if batch:
+            with profiling.phase( "solve" ):
+                ratings = accurate_perf_ratings_raw( [ (opp_ratings, score)
+                                                       for (opp_ratings, score, answer, line_number)
+                                                       in batch ] )
+            try:
+                for ((opp_ratings, score, answer, line_number), rating) in zip( batch, ratings ):
+                    if not np.isfinite( rating ):
+                        raise BadTournament( "line %d: no performance rating found" % line_number )
+                    out.write( answer( int( round( rating ) ) ) + "\n" )
+            finally:
+                out.flush()
+                del batch[:]
+    for (line_number, l) in enumerate( f, 1 ):
+        try:
+            tournament = parse_tournament_line( l )
+        except KeyError as e:
+            flush()
+            raise BadTournament( "line %d: no %s" % (line_number, e) )
+        except (ValueError, TypeError) as e:
+            flush()
+            raise BadTournament( "line %d: %s" % (line_number, e) )
+        if tournament:
+            batch.append( tournament + (line_number,) )
+            if len( batch ) >= BULK_BATCH:
+                flush()
+    flush()
+
+# Write profiling.report() as JSON to `path`, or standard output if it's "-"
+def write_profile( path ):
+    text = json.dumps( profiling.report(), indent=2 )
+    if path == "-":
+        print( text )
+    else:
+        with open( path, "w" ) as f:
+            f.write( text + "\n" )
+
+# Run as a program. Only what the chosen mode needs is loaded: --tnmt
+# and --tnmt_file never import matplotlib or requests, and should start
+# in about the time it takes to import NumPy (see the startup group in
+# bench/run.py).
+def main( argv=None ):
+    global global_options, fetcher, USCF_BASE
+    parser = argparse.ArgumentParser( description="Analyze USCF tournament performance results." )
+    parser.add_argument( "-i", "--id", help="USCF ID" )
+    parser.add_argument( "-b", "--batch", help="USCF IDs, or files listing them, to graph together",
+                         nargs="+" )
+    parser.add_argument( "-y", "--year", help="Initial year", type=int )
+    parser.add_argument( "-t", "--tnmt", help="Tournament results", nargs="*" )
+    parser.add_argument( "--tnmt_file", help="Tournament results, one tournament per line, from FILE "
+                         "(- for standard input): opponent ratings and score, as for --tnmt, separated "
+                         "by commas and optionally after a name, or JSON objects with opp_ratings "
+                         "and score", metavar="FILE" )
+    parser.add_argument( "-o", "--open", help="Open graph after computation", action="store_true" )
+    parser.add_argument( "--window", help="Games either side of each game to compute its performance from",
+                         type=int, default=WINDOW_SIZE )
+    parser.add_argument( "--window_days", help="Compute each game's performance from the games within "
+                         "this many days of it instead of a number of games", type=int )
+    parser.add_argument( "-f", "--full", help="Reread the whole tournament history, not just new pages",
+                         action="store_true" )
+    parser.add_argument( "-w", "--workers", help="Pages to fetch at once", type=int, default=4 )
+    parser.add_argument( "-j", "--processes", help="Processes for computing and drawing graphs in batch mode",
+                         type=int )
+    parser.add_argument( "--rate", help="Maximum requests per second to each host (0 for no limit)",
+                         type=float, default=4.0 )
+    parser.add_argument( "--base_url", help="Server to fetch USCF pages from", default=USCF_BASE )
+    parser.add_argument( "--cache_dir", help="Directory to cache downloaded pages in", default="cache" )
+    parser.add_argument( "--cache_size", help="Maximum size of the page cache in MB",
+                         type=float, default=100 )
+    parser.add_argument( "--offline", help="Use only cached pages; don't download anything",
+                         action="store_true" )
+    parser.add_argument( "--profile", help="At the end, write the time spent in each phase of the work, "
+                         "pages fetched, bytes downloaded or read from the cache and solver iterations "
+                         "as JSON to FILE (default: standard output)", nargs="?", const="-", metavar="FILE" )
+    parser.add_argument( "--cprofile", help="Run under cProfile and save its stats to FILE, "
+                         "for reading with pstats", metavar="FILE" )
+    global_options = parser.parse_args( argv )
+
+    USCF_BASE = global_options.base_url.rstrip( "/" )
+
+    if global_options.id or global_options.batch:
+        cache = uscfhttp.ResponseCache( global_options.cache_dir, int( global_options.cache_size * 2**20 ) )
+        fetcher = uscfhttp.Fetcher( global_options.workers, global_options.rate,
+                                    cache=cache, offline=global_options.offline )
+    profiling.enabled = bool( global_options.profile )
+    profiling.reset()
+    profiler = cProfile.Profile() if global_options.cprofile else None
+    if profiler:
+        profiler.enable()
+    try:
+        run_command()
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats( global_options.cprofile )
+        if global_options.profile:
+            write_profile( global_options.profile )
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,57 @@
 # Take a pgn file and split it up by time control
 # Particularly meant for PGN from ICC (chessclub.com)
+#
+# The input is read memory-mapped and cut, between games, into chunks of
+# about CHUNK_SIZE bytes that are split up in parallel. Games go to each
+# output file in the order they're in in the input.
+#
+# Given a time control or player, it instead writes just those games to
+# standard output, found with an index of the games in the file (see
+# GameIndex).
 
+import argparse
+import collections
+import hashlib
+import mmap
+import multiprocessing
+import os
 import os.path
 import re
+import sqlite3
 import sys
 
-file_dict = {}                  # time control to file handle
+parser = argparse.ArgumentParser( description="Split a PGN file into one file per time control, "
+                                  "named after the input file and the time control." )
+parser.add_argument( "in_filename",
+                     help="PGN file to split" )
+parser.add_argument( "-j",
+                     "--processes",
+                     type=int,
+                     help="Number of processes to split or index with (default: one per CPU)" )
+parser.add_argument( "-t",
+                     "--time_control",
+                     help="Write the games at this time control (as in the split files' names, "
+                     "e.g. '3 0', or as in the PGN, e.g. '180+0') to standard output "
+                     "instead of splitting" )
+parser.add_argument( "-p",
+                     "--player",
+                     help="Write the games this player played to standard output instead of "
+                     "splitting; with --time_control, just those at that time control" )
+parser.add_argument( "--index",
+                     help="Just bring the index of the games in the file up to date",
+                     action="store_true" )
 
-in_header = True
-game_lines = []
-time_control = "_"
+CHUNK_SIZE = 32 << 20           # Bytes of input per piece of work
+MAX_OPEN_FILES = 64             # Output files kept open at once
 
-def tc_to_file( rootname, tc ):
-    try:
-        return file_dict[tc]
-    except KeyError:
-        f = open( rootname + " " + tc + ".pgn", "w" )
-        file_dict[tc] = f
-        return f
+# Games start at a line beginning with "[" that follows one that doesn't;
+# a first line not beginning with "[" ends a game that's all preamble. A
+# line can end with "\r\n", "\n" or "\r", as when the file is read as text.
+EOL = rb"(?:\r\n|\n|\r(?!\n))"
+game_start_re = re.compile( rb"(?:^|" + EOL + rb")(?!\[)[^\r\n]*" + EOL + rb"(?=\[)" )
+header_end_re = re.compile( EOL + rb"(?!\[)" )
+time_control_re = re.compile( rb"TimeControl \"(.+)\"" )
+tag_re = re.compile( rb"^\[(\w+) \"(.*)\"\]$", re.M )
 
 def time_control_to_str( time_control ):
     elts = time_control.split( '+' )
@@ -26,30 +60,223 @@ def time_control_to_str( time_control ):
     else:
         return time_control
 
-def dump_game( rootname ):
-    global game_lines
-    global time_control
-    time_control_str = time_control_to_str( time_control )
-    f = tc_to_file( rootname, time_control_str )
-    f.writelines( game_lines )
-    time_control = "_"
-    game_lines = []
-
-in_filename = sys.argv[1]
-rootname = os.path.splitext( in_filename )[0]
-for l in open( in_filename ):
-    if l[0] == "[" and not in_header:
-        dump_game( rootname )
-        in_header = True
-    if in_header:
-        if l[0] == "[":
-            m = re.search( "TimeControl \"(.+)\"", l )
-            if m:
-                time_control = m.group( 1 )
-        else:
-            in_header = False
-    game_lines += l
-
-dump_game( rootname )
-for f in file_dict.values():
-    f.close()
+# Where to cut the input from `start` (the start of a game) on: [start of
+# each chunk] + [end of input]. Each chunk starts at a game, about
+# CHUNK_SIZE bytes after the previous one.
+def chunk_bounds( in_filename, start=0 ):
+    if os.path.getsize( in_filename ) <= start:
+        return [ start ]        # No chunks; and an empty file can't be mapped
+    with open( in_filename, "rb" ) as f:
+        data = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+        bounds = [ start ]
+        while bounds[-1] + CHUNK_SIZE < len( data ):
+            m = game_start_re.search( data, bounds[-1] + CHUNK_SIZE )
+            if not m:
+                break
+            bounds.append( m.end() )
+        bounds.append( len( data ) )
+        data.close()
+    return bounds
+
+# Time control of the game at data[start:end], as it goes in a filename:
+# the last one given in its header, or "_"
+def game_time_control( data, start, end ):
+    if data[start:start + 1] != b"[":
+        return "_"
+    m = header_end_re.search( data, start, end )
+    last = None
+    for last in time_control_re.finditer( data, start, m.start() if m else end ):
+        pass
+    if last is None:
+        return "_"
+    return time_control_to_str( os.fsdecode( last.group( 1 ) ) )
+
+def read_chunk( in_filename, start, end ):
+    with open( in_filename, "rb" ) as f:
+        mapped = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+        data = mapped[start:end]
+        mapped.close()
+    return data
+
+# Split up one chunk: (input filename, start, end) -> { time control:
+# games in it, in order }. Line endings come out as "\n".
+def split_chunk( job ):
+    data = read_chunk( *job )
+    if b"\r" in data:
+        data = data.replace( b"\r\n", b"\n" ).replace( b"\r", b"\n" )
+    starts = [ 0 ] + [ m.end() for m in game_start_re.finditer( data ) ]
+    games = collections.OrderedDict()
+    for (game_start, game_end) in zip( starts, starts[1:] + [ len( data ) ] ):
+        tc = game_time_control( data, game_start, game_end )
+        games.setdefault( tc, [] ).append( data[game_start:game_end] )
+    return collections.OrderedDict( (tc, b"".join( parts )) for (tc, parts) in games.items() )
+
+# Index one chunk: (input filename, start, end) -> [row of GameIndex's
+# games table] for each game in it. Preamble isn't a game.
+def index_chunk( job ):
+    (in_filename, start, end) = job
+    data = read_chunk( in_filename, start, end )
+    starts = [ 0 ] + [ m.end() for m in game_start_re.finditer( data ) ]
+    rows = []
+    for (game_start, game_end) in zip( starts, starts[1:] + [ len( data ) ] ):
+        if data[game_start:game_start + 1] != b"[":
+            continue
+        m = header_end_re.search( data, game_start, game_end )
+        header = data[game_start:m.start() if m else game_end]
+        if b"\r" in header:
+            header = header.replace( b"\r\n", b"\n" ).replace( b"\r", b"\n" )
+        tags = dict( (name, value.decode( "utf-8", "replace" ))
+                     for (name, value) in tag_re.findall( header ) )
+        rows.append( (start + game_start, game_end - game_start,
+                      game_time_control( header, 0, len( header ) ),
+                      tags.get( b"White" ), tags.get( b"Black" ),
+                      tags.get( b"Date" ), tags.get( b"Result" )) )
+    return rows
+
+# Results of fn on each job, in order, computed by `processes` processes
+# at a time. Only a few results are ever waiting to be used, so memory use
+# doesn't grow with the number of jobs.
+def map_in_order( fn, jobs, processes ):
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1 or len( jobs ) == 1:
+        for job in jobs:
+            yield fn( job )
+        return
+    pool = multiprocessing.Pool( processes )
+    pending = collections.deque()
+    for job in jobs:
+        pending.append( pool.apply_async( fn, (job,) ) )
+        if len( pending ) > 2 * processes:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+    pool.close()
+    pool.join()
+
+# The output files, by time control. The least recently written is closed
+# when more than MAX_OPEN_FILES would be open, and appended to if it's
+# needed again.
+class OutputFiles():
+    def __init__( self, rootname ):
+        self.rootname = rootname
+        self.open_files = collections.OrderedDict() # Least recently used first
+        self.created = set()
+
+    def write( self, tc, data ):
+        f = self.open_files.pop( tc, None )
+        if f is None:
+            if len( self.open_files ) >= MAX_OPEN_FILES:
+                self.open_files.popitem( last=False )[1].close()
+            f = open( self.rootname + " " + tc + ".pgn", "ab" if tc in self.created else "wb" )
+            self.created.add( tc )
+        self.open_files[tc] = f
+        f.write( data )
+
+    def close( self ):
+        for f in self.open_files.values():
+            f.close()
+        self.open_files.clear()
+
+# How much of a PGN file, just before the last game in the index, to check
+# for changes before deciding that the file has only been added to
+CHECKSUM_SPAN = 1 << 16
+
+# Index of the games in a PGN file, kept in <pgn_file>.index next to it:
+# where each game is, and the tags it's looked up by. If the file has only
+# had games added since it was last indexed, only the new games and the
+# last old one (which may have had moves added) are read; otherwise the
+# whole file is.
+class GameIndex():
+    def __init__( self, pgn_file, processes=None ):
+        self.pgn_file = pgn_file
+        self.db = sqlite3.connect( pgn_file + ".index" )
+        self.db.executescript( "CREATE TABLE IF NOT EXISTS stamp "
+                               "(size INTEGER, mtime REAL, last INTEGER, checksum TEXT);"
+                               "CREATE TABLE IF NOT EXISTS games "
+                               "(offset INTEGER PRIMARY KEY, length INTEGER NOT NULL, "
+                               "time_control TEXT, white TEXT, black TEXT, date TEXT, result TEXT);"
+                               "CREATE INDEX IF NOT EXISTS games_time_control ON games (time_control);"
+                               "CREATE INDEX IF NOT EXISTS games_white ON games (white COLLATE NOCASE);"
+                               "CREATE INDEX IF NOT EXISTS games_black ON games (black COLLATE NOCASE);" )
+        self.update( processes )
+
+    # Hash of the CHECKSUM_SPAN bytes before `offset`
+    def checksum( self, offset ):
+        with open( self.pgn_file, "rb" ) as f:
+            f.seek( max( 0, offset - CHECKSUM_SPAN ) )
+            return hashlib.sha1( f.read( min( offset, CHECKSUM_SPAN ) ) ).hexdigest()
+
+    # Index whatever's new in the file. Returns how many games were read.
+    def update( self, processes=None ):
+        size = os.path.getsize( self.pgn_file )
+        mtime = os.path.getmtime( self.pgn_file )
+        stamp = self.db.execute( "SELECT size, mtime, last, checksum FROM stamp" ).fetchone()
+        if stamp and stamp[:2] == (size, mtime):
+            return 0
+        start = 0
+        if stamp and size >= stamp[0] and self.checksum( stamp[2] ) == stamp[3]:
+            start = stamp[2]
+        bounds = chunk_bounds( self.pgn_file, start )
+        jobs = [ (self.pgn_file, b, e) for (b, e) in zip( bounds, bounds[1:] ) ]
+        count = 0
+        with self.db:
+            self.db.execute( "DELETE FROM games WHERE offset >= ?", (start,) )
+            for rows in map_in_order( index_chunk, jobs, processes ):
+                self.db.executemany( "INSERT INTO games VALUES (?, ?, ?, ?, ?, ?, ?)", rows )
+                count += len( rows )
+            last = self.db.execute( "SELECT MAX( offset ) FROM games" ).fetchone()[0] or 0
+            self.db.execute( "DELETE FROM stamp" )
+            self.db.execute( "INSERT INTO stamp VALUES (?, ?, ?, ?)",
+                             (size, mtime, last, self.checksum( last )) )
+        return count
+
+    # -> [(offset, length)] of the games at a time control (as it goes in
+    # a filename) and/or with a player, in file order
+    def find( self, time_control=None, player=None ):
+        conditions = []
+        params = []
+        if time_control is not None:
+            conditions.append( "time_control = ?" )
+            params.append( time_control )
+        if player is not None:
+            conditions.append( "(white = ? COLLATE NOCASE OR black = ? COLLATE NOCASE)" )
+            params += [ player, player ]
+        query = "SELECT offset, length FROM games"
+        if conditions:
+            query += " WHERE " + " AND ".join( conditions )
+        return self.db.execute( query + " ORDER BY offset", params ).fetchall()
+
+    def close( self ):
+        self.db.close()
+
+# Copy the games at [(offset, length)] of a PGN file to `out`, as they are
+def write_games( pgn_file, games, out ):
+    with open( pgn_file, "rb" ) as f:
+        for (offset, length) in games:
+            f.seek( offset )
+            out.write( f.read( length ) )
+
+def split_pgn( in_filename, processes ):
+    output = OutputFiles( os.path.splitext( in_filename )[0] )
+    bounds = chunk_bounds( in_filename )
+    jobs = [ (in_filename, start, end) for (start, end) in zip( bounds, bounds[1:] ) ]
+    if not jobs:
+        output.write( "_", b"" ) # Nothing to split, but there's always an output file
+    for games in map_in_order( split_chunk, jobs, processes ):
+        for (tc, data) in games.items():
+            output.write( tc, data )
+    output.close()
+
+if __name__ == "__main__":
+    global_options = parser.parse_args()
+    if global_options.index or global_options.time_control or global_options.player:
+        index = GameIndex( global_options.in_filename, global_options.processes )
+        if global_options.time_control or global_options.player:
+            time_control = global_options.time_control
+            if time_control:
+                time_control = time_control_to_str( time_control )
+            games = index.find( time_control, global_options.player )
+            write_games( global_options.in_filename, games, sys.stdout.buffer )
+        index.close()
+    else:
+        split_pgn( global_options.in_filename, global_options.processes )
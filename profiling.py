@@ -0,0 +1,114 @@
+# Phase timing for perf.py's --profile
+#
+# Code marks the phases of its work with phase() or @timed, and counts
+# things (bytes fetched, solver iterations) with count(). When profiling
+# is on, report() gives the wall time and number of calls of each phase
+# and the total of each counter; when it's off, which is the default,
+# they cost a function call. Phases may nest, and a phase's time includes
+# that of any phases inside it. Phases running at once on several threads
+# each count their own time in full.
+
+import contextlib
+import functools
+import threading
+import time
+
+enabled = False
+
+lock = threading.Lock()
+phases = {}                     # name -> [calls, seconds]
+counters = {}                   # name -> total
+start_time = time.perf_counter()
+
+def reset():
+    global start_time
+    with lock:
+        phases.clear()
+        counters.clear()
+        start_time = time.perf_counter()
+
+def add_time( name, seconds, calls=1 ):
+    with lock:
+        entry = phases.setdefault( name, [ 0, 0.0 ] )
+        entry[0] += calls
+        entry[1] += seconds
+
+def count( name, amount=1 ):
+    if enabled:
+        with lock:
+            counters[name] = counters.get( name, 0 ) + amount
+
+# with phase( "name" ): ...
+@contextlib.contextmanager
+def phase( name ):
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time( name, time.perf_counter() - start )
+
+# Decorator: each call of the function is a phase called `name`
+def timed( name ):
+    def decorate( fn ):
+        @functools.wraps( fn )
+        def wrapper( *args, **kwargs ):
+            with phase( name ):
+                return fn( *args, **kwargs )
+        return wrapper
+    return decorate
+
+# Chunks from an iterator (a page being downloaded, say) -> the same
+# chunks, with the time spent waiting for each counted as phase `name`,
+# so that it doesn't count towards whatever phase is consuming them, and
+# their total length as counter `size_counter` if given
+def metered( chunks, name, size_counter=None ):
+    if not enabled:
+        yield from chunks
+        return
+    chunks = iter( chunks )
+    calls = 0
+    seconds = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next( chunks )
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - start
+            if size_counter:
+                count( size_counter, len( chunk ) )
+            yield chunk
+    finally:
+        add_time( name, seconds, 1 )
+
+# -> { "wall_seconds": time since reset(),
+#      "phases": { name: { "calls": n, "seconds": s } },
+#      "counters": { name: total } }
+def report():
+    with lock:
+        return { "wall_seconds": time.perf_counter() - start_time,
+                 "phases": dict( (name, { "calls": calls, "seconds": seconds })
+                                 for (name, (calls, seconds)) in sorted( phases.items() ) ),
+                 "counters": dict( sorted( counters.items() ) ) }
+
+# Add what report() said in another process to what's been recorded here
+def merge( other ):
+    for (name, entry) in other["phases"].items():
+        add_time( name, entry["seconds"], entry["calls"] )
+    with lock:
+        for (name, total) in other["counters"].items():
+            counters[name] = counters.get( name, 0 ) + total
+
+# fn(*args), in a worker process, with profiling on -> (what it returned,
+# report() of the call) for merge()
+def collect( fn, *args ):
+    global enabled
+    enabled = True
+    reset()
+    ans = fn( *args )
+    return (ans, report())
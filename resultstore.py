@@ -0,0 +1,108 @@
+# On-disk store of one player's game and tournament results
+#
+# Results live in an SQLite database with one row per game, keyed by
+# (xtbl, rd), and one row per tournament, keyed by xtbl. New results are
+# appended with INSERT OR IGNORE, so saving never rewrites what's already
+# there, and the columns the rating solver needs can be read straight
+# into NumPy arrays.
+
+import datetime
+import numpy as np
+import os
+import sqlite3
+
+# A player's whole game history as a structured array, one record per
+# game, with the date and score already decoded from the crosstable ID and
+# result code
+HISTORY_DTYPE = np.dtype( [ ("opp_rating", np.int32),
+                            ("score", np.float64),
+                            ("xtbl", np.int64),
+                            ("rd", np.int16),
+                            ("year", np.int16),
+                            ("date", np.int32) ] ) # as datetime.date.toordinal()
+
+EPOCH_ORDINAL = datetime.date( 1970, 1, 1 ).toordinal()
+
+# Array of dates as yyyymmdd integers -> array of date ordinals
+def ymd_to_ordinals( ymd ):
+    months = (ymd // 10000 - 1970) * 12 + (ymd // 100 % 100 - 1)
+    days = months.astype( "datetime64[M]" ).astype( "datetime64[D]" ) + (ymd % 100 - 1)
+    return days.astype( np.int64 ) + EPOCH_ORDINAL
+
+# Columns of opponent rating, score, xtbl as an integer, round and the
+# yyyymmdd date the xtbl starts with -> history array
+def history_from_columns( opp_ratings, scores, xtbls, rds, ymds ):
+    ymds = np.asarray( ymds, dtype=np.int64 )
+    ans = np.empty( len( ymds ), dtype=HISTORY_DTYPE )
+    ans["opp_rating"] = opp_ratings
+    ans["score"] = scores
+    ans["xtbl"] = xtbls
+    ans["rd"] = rds
+    ans["year"] = ymds // 10000
+    ans["date"] = ymd_to_ordinals( ymds )
+    return ans
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    xtbl TEXT NOT NULL,
+    rd INTEGER NOT NULL,
+    opp_rating INTEGER NOT NULL,
+    result TEXT NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (xtbl, rd)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tournaments (
+    xtbl TEXT PRIMARY KEY,
+    rating INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+class ResultStore():
+    def __init__( self, path ):
+        directory = os.path.dirname( path )
+        if directory:
+            os.makedirs( directory, exist_ok=True )
+        self.db = sqlite3.connect( path )
+        self.db.executescript( SCHEMA )
+
+    def is_empty( self ):
+        return self.db.execute( "SELECT NOT EXISTS (SELECT 1 FROM results) "
+                                "AND NOT EXISTS (SELECT 1 FROM tournaments)" ).fetchone()[0] == 1
+
+    # -> [(opp_rating, result, xtbl, rd)] in (xtbl, rd) order; each tuple
+    # is in the order of perf.Result's constructor arguments
+    def results( self ):
+        return self.db.execute( "SELECT opp_rating, result, xtbl, rd FROM results "
+                                "ORDER BY xtbl, rd" ).fetchall()
+
+    # -> [(xtbl, rating)] in xtbl order
+    def tournament_results( self ):
+        return self.db.execute( "SELECT xtbl, rating FROM tournaments ORDER BY xtbl" ).fetchall()
+
+    # -> history array (see HISTORY_DTYPE), in (xtbl, rd) order
+    def history( self ):
+        rows = self.db.execute( "SELECT opp_rating, score, CAST(xtbl AS INTEGER), rd, "
+                                "CAST(substr(xtbl, 1, 8) AS INTEGER) FROM results "
+                                "ORDER BY xtbl, rd" ).fetchall()
+        # Every value fits exactly in a double
+        c = np.array( rows, dtype=np.float64 ).reshape( -1, 5 )
+        return history_from_columns( c[:, 0], c[:, 1], c[:, 2].astype( np.int64 ), c[:, 3], c[:, 4] )
+
+    # Add [(xtbl, rd, opp_rating, result, score)], skipping games we
+    # already have. Returns the number of games added.
+    def add_results( self, rows ):
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany( "INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?, ?)", rows )
+            return self.db.total_changes - before
+
+    # Add [(xtbl, rating)], skipping tournaments we already have. Returns
+    # the number of tournaments added.
+    def add_tournament_results( self, rows ):
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany( "INSERT OR IGNORE INTO tournaments VALUES (?, ?)", rows )
+            return self.db.total_changes - before
+
+    def close( self ):
+        self.db.close()
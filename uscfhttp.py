@@ -0,0 +1,206 @@
+# HTTP access to the USCF member services pages
+#
+# A Fetcher shares one pooled requests.Session between a bounded pool of
+# worker threads, and spaces out requests to each host so that fetching
+# many pages at once doesn't hammer the server. Responses can be kept in
+# an on-disk ResponseCache so that pages that haven't changed aren't
+# downloaded again.
+
+import codecs
+import hashlib
+import json
+import os
+import profiling
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# Makes sure that requests to any one host start at least 1/rate seconds
+# apart. A rate of 0 or None means no limit.
+class RateLimiter():
+    def __init__( self, rate ):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = {}     # host -> earliest time of next request
+
+    # Block until it's this thread's turn to send a request to `host`
+    def wait( self, host ):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max( now, self.next_slot.get( host, now ) )
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep( slot - now )
+
+# Raised by an offline Fetcher asked for a page it doesn't have
+class CacheMiss( Exception ):
+    pass
+
+# Page bodies on disk, keyed by a hash of their URL. Each entry is a
+# <key>.body file holding the raw bytes and a <key>.json file holding the
+# URL, when it was fetched, its encoding and the validators (ETag,
+# Last-Modified) needed to revalidate it. Once the bodies take up more
+# than max_bytes, the least recently used entries are deleted.
+class ResponseCache():
+    def __init__( self, directory, max_bytes=100 * 2**20 ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs( directory, exist_ok=True )
+        self.total_bytes = sum( e.stat().st_size for e in os.scandir( directory )
+                                if e.name.endswith( ".body" ) )
+
+    # url -> (metadata path, body path)
+    def paths( self, url ):
+        key = hashlib.sha256( url.encode( "utf-8" ) ).hexdigest()
+        return (os.path.join( self.directory, key + ".json" ),
+                os.path.join( self.directory, key + ".body" ))
+
+    # url -> (metadata, body bytes), or None if we don't have it
+    def lookup( self, url ):
+        (meta_path, body_path) = self.paths( url )
+        try:
+            with open( meta_path ) as f:
+                meta = json.load( f )
+            with open( body_path, "rb" ) as f:
+                body = f.read()
+            os.utime( meta_path )   # Mark as recently used
+        except (IOError, ValueError):
+            return None
+        return (meta, body)
+
+    # Write `data` to `path` so that readers never see a partial file
+    def write_file( self, path, data, mode ):
+        tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+        with open( tmp_path, mode ) as f:
+            f.write( data )
+        os.replace( tmp_path, path )
+
+    # Record that the cached copy of `url` is still current as of now
+    def refresh( self, url, meta ):
+        meta["fetched"] = time.time()
+        self.write_file( self.paths( url )[0], json.dumps( meta ), "w" )
+
+    def store( self, url, body, meta ):
+        (meta_path, body_path) = self.paths( url )
+        with self.lock:
+            try:
+                self.total_bytes -= os.path.getsize( body_path )
+            except OSError:
+                pass
+            self.write_file( body_path, body, "wb" )
+            self.write_file( meta_path, json.dumps( meta ), "w" )
+            self.total_bytes += len( body )
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    # Delete least recently used entries until we're under max_bytes.
+    # Must be called with the lock held.
+    def evict( self ):
+        entries = []            # (last use, metadata path, body path)
+        for e in os.scandir( self.directory ):
+            if e.name.endswith( ".json" ):
+                body_path = e.path[:-len( ".json" )] + ".body"
+                entries.append( (e.stat().st_mtime, e.path, body_path) )
+        entries.sort()
+        for (last_use, meta_path, body_path) in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                size = os.path.getsize( body_path )
+                os.remove( meta_path )
+                os.remove( body_path )
+                self.total_bytes -= size
+            except OSError:
+                pass
+
+# Bytes read from the network at a time by Fetcher.stream()
+CHUNK_SIZE = 16384
+
+class Fetcher():
+    # If `cache` (a ResponseCache) is given, pages are served from it while
+    # they're fresh. If `offline` is set, nothing is fetched at all: every
+    # page must come from the cache, however old.
+    def __init__( self, workers=4, rate=4.0, timeout=30, cache=None, offline=False ):
+        self.workers = workers
+        self.timeout = timeout
+        self.cache = cache
+        self.offline = offline
+        self.limiter = RateLimiter( rate )
+        import requests         # Slow to import, and only needed to fetch
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter( pool_maxsize=workers )
+        self.session.mount( "http://", adapter )
+        self.session.mount( "https://", adapter )
+        self.executor = ThreadPoolExecutor( max_workers=workers )
+
+    # url -> page text
+    #
+    # A cached copy younger than `ttl` seconds is used as is; ttl=None
+    # means a cached copy never goes stale. An older copy is revalidated
+    # with a conditional request, so an unchanged page costs a 304 rather
+    # than a full download.
+    def get( self, url, ttl=0 ):
+        return "".join( self.stream( url, ttl ) )
+
+    # url -> iterator of pieces of the page text, as get() would return it,
+    # produced as they arrive from the server so that the caller can parse
+    # the start of a page while the rest is still downloading
+    def stream( self, url, ttl=0 ):
+        cached = self.cache.lookup( url ) if self.cache else None
+        if cached:
+            (meta, body) = cached
+            if self.offline or ttl is None or time.time() - meta["fetched"] < ttl:
+                profiling.count( "bytes_from_cache", len( body ) )
+                yield body.decode( meta["encoding"], "replace" )
+                return
+        elif self.offline:
+            raise CacheMiss( url )
+
+        headers = {}
+        if cached:
+            if meta.get( "etag" ):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get( "last_modified" ):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        self.limiter.wait( urlsplit( url ).netloc )
+        with self.session.get( url, headers=headers, timeout=self.timeout, stream=True ) as r:
+            if cached and r.status_code == 304:
+                self.cache.refresh( url, meta )
+                profiling.count( "bytes_from_cache", len( body ) )
+                yield body.decode( meta["encoding"], "replace" )
+                return
+            r.raise_for_status()
+            if r.encoding is None:
+                # Only the whole body is enough to guess the encoding from
+                r.encoding = r.apparent_encoding
+            decoder = codecs.getincrementaldecoder( r.encoding )( "replace" )
+            pieces = []         # Raw body, for the cache
+            for piece in r.iter_content( CHUNK_SIZE ):
+                pieces.append( piece )
+                profiling.count( "bytes_downloaded", len( piece ) )
+                text = decoder.decode( piece )
+                if text:
+                    yield text
+            text = decoder.decode( b"", True )
+            if text:
+                yield text
+            if self.cache:
+                meta = { "url": url,
+                         "fetched": time.time(),
+                         "encoding": r.encoding,
+                         "etag": r.headers.get( "ETag" ),
+                         "last_modified": r.headers.get( "Last-Modified" ) }
+                self.cache.store( url, b"".join( pieces ), meta )
+
+    # Call fn on each element of `items` on the worker threads and return
+    # the results in the same order. `fn` will typically call get().
+    def map( self, fn, items ):
+        return list( self.executor.map( fn, items ) )
+
+    def close( self ):
+        self.executor.shutdown()
+        self.session.close()